@@ -0,0 +1,88 @@
+import sys
+import json
+import argparse
+from keter.stage import get_path
+from keter.util.manifest import find_artifacts, read_manifest, verify
+
+
+def _artifacts(products):
+    for product in products:
+        root = get_path(product)
+        if root.exists():
+            for path in find_artifacts(root):
+                yield product, root, path
+
+
+def list_datasets(args) -> int:
+    manifests = []
+    for product, root, path in _artifacts(args.products):
+        manifest = read_manifest(path)
+        manifest["product"] = product
+        manifest["name"] = path.relative_to(root).as_posix()
+        manifests.append(manifest)
+
+    if args.json:
+        print(json.dumps(manifests, indent=2))
+        return 0
+    print(f"{'dataset':<56} {'rows':>12} {'columns':>8} {'MiB':>10}")
+    for manifest in manifests:
+        name = f"{manifest['product']}/{manifest['name']}"
+        print(
+            f"{name:<56} {manifest['rows']:>12} {len(manifest['schema']):>8} "
+            f"{manifest['bytes'] / 2 ** 20:>10.1f}"
+        )
+    return 0
+
+
+def show_dataset(args) -> int:
+    for product, root, path in _artifacts(args.products):
+        if path.relative_to(root).as_posix() in (args.name, args.name + ".parquet"):
+            print(json.dumps(read_manifest(path), indent=2))
+            return 0
+    print(f"No dataset named {args.name}", file=sys.stderr)
+    return 1
+
+
+def verify_datasets(args) -> int:
+    failures = 0
+    for product, root, path in _artifacts(args.products):
+        problems = verify(path)
+        name = f"{product}/{path.relative_to(root).as_posix()}"
+        print(f"{name}: {', '.join(problems) if problems else 'OK'}")
+        failures += bool(problems)
+    return 1 if failures else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="keter", description="Inspect the datasets in the Keter cache."
+    )
+    parser.add_argument(
+        "--product",
+        dest="products",
+        action="append",
+        choices=["raw", "constructed", "output"],
+        help="Only look at one product, may be repeated",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = commands.add_parser("list", help="List cached datasets")
+    list_parser.add_argument("--json", action="store_true", help="Print manifests")
+    list_parser.set_defaults(func=list_datasets)
+
+    show_parser = commands.add_parser("show", help="Print the manifest of a dataset")
+    show_parser.add_argument("name", help="Dataset name, such as pcba")
+    show_parser.set_defaults(func=show_dataset)
+
+    verify_parser = commands.add_parser(
+        "verify", help="Check cached datasets against their manifests"
+    )
+    verify_parser.set_defaults(func=verify_datasets)
+
+    args = parser.parse_args(argv)
+    args.products = args.products or ["raw", "constructed", "output"]
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
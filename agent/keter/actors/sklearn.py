@@ -11,30 +11,45 @@ from sklearn.metrics import roc_auc_score
 from keter.datasets.constructed import Safety, Feasibility
 from keter.datasets.raw import Tox21, Bbbp
 from keter.actors.vectors import ChemicalLanguage
-from keter.stage import cache
+from keter.stage import cache, fingerprint
 
 
 class Analyzer:
     filename = "analyzer"
 
-    def __init__(self, mode="prod"):
+    def __init__(self, mode="prod", workers=None):
         model_file = f"{self.filename}_{mode}.pkz"
 
+        canonical = "canonical" in mode
         if "doc2vec" in mode:
-            self.preprocessor = ChemicalLanguage("doc2vec")
+            self.preprocessor = ChemicalLanguage(
+                "doc2vec", workers, canonical=canonical
+            )
         elif "lda" in mode:
-            self.preprocessor = ChemicalLanguage("lda")
+            self.preprocessor = ChemicalLanguage("lda", workers, canonical=canonical)
         else:
-            self.preprocessor = ChemicalLanguage("bow")
+            # Sparse bag of words features keep screening blocks small in memory
+            self.preprocessor = ChemicalLanguage(
+                "bow", workers, "sparse" in mode, canonical=canonical
+            )
         if "test" in mode:
             self.safety, self.feasibility, self.bbbp = self.train(
                 score=True, task_duration=12000
             )
         else:
             self.safety, self.feasibility, self.bbbp = cache(
-                "model", model_file, self.train
+                "model", model_file, self.train, key=self.key()
             )
 
+    def key(self) -> str:
+        return fingerprint(
+            self.train,
+            self.preprocessor.key(),
+            Safety().key(),
+            Feasibility().key(),
+            Bbbp().key(),
+        )
+
     def train(self, score=False, task_duration=32400):
         safety_task_duration = task_duration // 2
         feasibility_task_duration = task_duration // 4
@@ -162,4 +177,4 @@ class Benchmarks:
         return model
 
     def analyze(self, smiles: Sequence[str]) -> Sequence[float]:
-        return self.model.predict(self.preprocessor.transform(smiles))
\ No newline at end of file
+        return self.model.predict(self.preprocessor.transform(smiles))
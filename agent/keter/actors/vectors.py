@@ -2,50 +2,53 @@ import pickle
 import lzma
 from typing import Sequence
 from keter.models.vectors import ChemicalLanguageModule, ChemicalLanguageHyperparameters
-from keter.datasets.constructed import Unlabeled, Safety
-from keter.stage import cache
+from keter.datasets.constructed import Unlabeled, CanonicalUnlabeled, Safety
+from keter.stage import cache, fingerprint
 
 
 class ChemicalLanguage:
     filename = "chemical_language"
+    modes = {
+        "default": {},
+        "bow": {
+            "vector_algo": "bow",
+            "max_vocab": 5000,
+            "max_ngram": 4,
+            "token_ids": True,
+        },
+        "lda": {"vector_algo": "lda", "topics": 1000, "token_ids": True},
+        "doc2vec": {"doc_epochs": 300, "vec_dims": 512, "token_ids": True},
+    }
 
-    def __init__(self, mode="bow"):
+    def __init__(self, mode="bow", workers=None, sparse=False, canonical=False):
         model_file = f"{self.filename}_{mode}.pkz"
+        # The canonical corpus is RDKit canonicalized and deduplicated by InChIKey
+        self.unlabeled = CanonicalUnlabeled() if canonical else Unlabeled()
+        if canonical:
+            model_file = f"{self.filename}_{mode}_canonical.pkz"
 
-        if mode == "default":
-            self.model = cache("model", model_file, self.train)
-        elif mode == "bow":
-            self.model = cache(
-                "model",
-                model_file,
-                lambda: self.train(
-                    ChemicalLanguageHyperparameters.from_dict(
-                        {"vector_algo": "bow", "max_vocab": 5000, "max_ngram": 4}
-                    )
-                ),
-            )
-        elif mode == "lda":
-            self.model = cache(
-                "model",
-                model_file,
-                lambda: self.train(
-                    ChemicalLanguageHyperparameters.from_dict(
-                        {"vector_algo": "lda", "topics": 1000}
-                    )
-                ),
-            )
-        elif mode == "doc2vec":
-            self.model = cache(
-                "model",
-                model_file,
-                lambda: self.train(
-                    ChemicalLanguageHyperparameters.from_dict(
-                        {"doc_epochs": 300, "vec_dims": 512}
-                    )
-                ),
-            )
-        else:
+        if mode not in self.modes:
             raise ValueError("Invalid mode: " + mode)
+        self.hyperparams = ChemicalLanguageHyperparameters.from_dict(self.modes[mode])
+        if sparse and self.hyperparams.vector_algo != "bow":
+            raise ValueError("Sparse vectors are only available in bow mode")
+        # Return bag of words vectors as a sparse CSR matrix
+        self.sparse = sparse
+        # Processes tokenizing molecules, defaults to one per core
+        self.workers = workers
+        self.model = cache(
+            "model", model_file, lambda: self.train(self.hyperparams), key=self.key()
+        )
+        self.model.workers = workers
+
+    def key(self) -> str:
+        return fingerprint(
+            self.train,
+            ChemicalLanguageModule,
+            self.hyperparams,
+            Safety().key(),
+            self.unlabeled.key(),
+        )
 
     def train(self, hyperparams=ChemicalLanguageHyperparameters()):
         safety = Safety().to_df()
@@ -53,8 +56,9 @@ class ChemicalLanguage:
         y = safety.drop("smiles", axis=1)
         y["safety"] = safety.apply(lambda x: 1 if x.safety > 0.7 else 0, axis=1)
         model = ChemicalLanguageModule(hyperparams)
-        model.fit(Unlabeled().to_list(), X, y)
+        model.workers = self.workers
+        model.fit(self.unlabeled.to_list(), X, y)
         return model
 
     def transform(self, smiles: Sequence[str]) -> Sequence[str]:
-        return self.model.to_vecs(smiles)
+        return self.model.to_vecs(smiles, sparse=self.sparse)
@@ -0,0 +1,402 @@
+"""
+Benchmarks of the performance work on Keter, each comparing a fast path with the
+reference it replaces on synthetic data and checking that both agree. Run them
+with, for example::
+
+    python -c 'from keter.benchmarks import *; benchmark_tokenizer()'
+"""
+
+import numpy as np
+
+
+def _synthetic_smiles(rng: np.random.Generator, molecules: int) -> list:
+    """
+    Random SMILES strings with the token mix and length of MOSES molecules.
+    """
+    alphabet = np.array(
+        list("CCCCccccNnOo()=1234") + ["Cl", "Br", "F", "S", "[nH]", "[C@@H]", "#"]
+    )
+    lengths = rng.integers(20, 60, molecules)
+    tokens = rng.choice(alphabet, lengths.sum())
+    return ["".join(chunk) for chunk in np.split(tokens, np.cumsum(lengths)[:-1])]
+
+
+def benchmark_artifact_codecs(size_mb=256, repeat=3):
+    import tempfile
+    from time import perf_counter
+    from pathlib import Path
+    from keter.stage import NullStage, ARTIFACT_CODECS
+
+    # Shaped like a vector model: a few large float32 buffers and a vocabulary
+    rng = np.random.default_rng(18)
+    rows = size_mb * 2 ** 20 // 4 // 512 // 2
+    artifact = {
+        "vectors": rng.standard_normal((rows, 512), dtype=np.float32),
+        "syn1neg": rng.standard_normal((rows, 512), dtype=np.float32),
+        "vocab": {f"token{i}": i for i in range(rows)},
+    }
+
+    stage = NullStage()
+    with stage, tempfile.TemporaryDirectory() as tmp:
+        for codec, suffix in ARTIFACT_CODECS.items():
+            path = Path(tmp) / f"artifact{suffix}"
+            start = perf_counter()
+            stage._write_cache(path, artifact)
+            write_time = perf_counter() - start
+
+            load_times = []
+            for _ in range(repeat):
+                start = perf_counter()
+                loaded = stage._read_cache(path)
+                # Touch every page so lazily mapped artifacts pay their full cost
+                float(loaded["vectors"].sum() + loaded["syn1neg"].sum())
+                load_times.append(perf_counter() - start)
+                del loaded
+
+            print(
+                f"{codec}: {path.stat().st_size / 2 ** 20:.0f} MiB on disk, "
+                f"write {write_time:.2f}s, load {min(load_times):.2f}s"
+            )
+
+
+def benchmark_tox21_construct(molecules=8000, rows_per_assay=12000, repeat=3):
+    from time import perf_counter
+    import pandas as pd
+    from keter.datasets.constructed_safety import Tox21Full
+
+    # Synthetic aggregated assay files with repeated measurements per molecule
+    rng = np.random.default_rng(18)
+    outcomes = np.array(
+        ["active agonist", "active antagonist", "inactive", "inconclusive", None],
+        dtype=object,
+    )
+    smiles = np.array([f"C{i}CO" for i in range(molecules)], dtype=object)
+    assay_dfs = [
+        (
+            assay,
+            pd.DataFrame(
+                {
+                    "SMILES": rng.choice(smiles, rows_per_assay),
+                    "ASSAY_OUTCOME": rng.choice(outcomes, rows_per_assay),
+                }
+            ),
+        )
+        for assay in Tox21Full.tox21_assays
+    ]
+
+    timings = {}
+    results = {}
+    for name, assemble in (
+        ("reference", Tox21Full._assemble_reference),
+        ("vectorized", Tox21Full._assemble),
+    ):
+        times = []
+        for _ in range(repeat):
+            start = perf_counter()
+            results[name] = assemble(assay_dfs)
+            times.append(perf_counter() - start)
+        timings[name] = min(times)
+        print(f"{name}: {timings[name]:.2f}s")
+
+    pd.testing.assert_frame_equal(results["reference"], results["vectorized"])
+    print(
+        f"Identical output, {timings['reference'] / timings['vectorized']:.1f}x faster"
+    )
+
+
+def benchmark_infection_index(
+    counties=3300, days=1000, total_deaths=1100000, queries=20
+):
+    import os
+    import tempfile
+    from time import perf_counter
+    import pandas as pd
+    from keter.stage import FileSystemStage, get_path, locate
+    from keter.datasets.raw import CoronaDeathsUSA
+    from keter.datasets.constructed import InfectionNet
+
+    old_cache = os.environ.get("KETER_CACHE")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.environ["KETER_CACHE"] = tmp
+
+            # Synthetic JHU style time series at the volume of the US epidemic
+            rng = np.random.default_rng(18)
+            weights = rng.pareto(1.2, counties) + 1
+            weights = np.repeat(weights / (weights.sum() * days), days)
+            daily = rng.multinomial(total_deaths, weights).reshape(counties, days)
+            cumulative = np.cumsum(daily, axis=1)
+            dates = pd.date_range("2020-01-22", periods=days)
+            timestamps = (dates - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+            corona_deaths = pd.DataFrame(
+                {
+                    "UID": 84000000 + np.arange(counties),
+                    "Lat": rng.uniform(25, 49, counties),
+                    "Long_": rng.uniform(-124, -67, counties),
+                }
+            )
+            corona_deaths = pd.concat(
+                [
+                    corona_deaths,
+                    pd.DataFrame(
+                        cumulative, columns=[f"{d.month}/{d.day}/{d:%y}" for d in dates]
+                    ),
+                ],
+                axis=1,
+            )
+            get_path("raw").mkdir(parents=True, exist_ok=True)
+            corona_deaths.to_parquet(
+                get_path("raw") / f"{CoronaDeathsUSA.filename}.parquet"
+            )
+
+            with FileSystemStage(content_addressed=False):
+                infectionnet = InfectionNet()
+                start = perf_counter()
+                path = locate(
+                    "constructed",
+                    infectionnet.filename + ".parquet",
+                    infectionnet.construct,
+                    writer=infectionnet._write_partitions,
+                )
+                print(f"Built index in {perf_counter() - start:.1f}s")
+
+                # Two degree boxes over two week windows
+                boxes = [
+                    {
+                        "lat": (lat, lat + 2),
+                        "long": (long_, long_ + 2),
+                        "time": (time, time + 14 * 86400),
+                    }
+                    for lat, long_, time in zip(
+                        rng.uniform(25, 47, queries),
+                        rng.uniform(-124, -69, queries),
+                        rng.choice(timestamps[30:-30], queries),
+                    )
+                ]
+
+                start = perf_counter()
+                records = pd.read_parquet(path)
+                print(
+                    f"Full scan of {len(records)} records: {perf_counter() - start:.2f}s"
+                )
+                del records
+
+                start = perf_counter()
+                matched = sum(len(infectionnet.query(**box)) for box in boxes)
+                print(
+                    f"Indexed queries: {(perf_counter() - start) / queries:.3f}s "
+                    f"per query, {matched // queries} records on average"
+                )
+    finally:
+        if old_cache is None:
+            os.environ.pop("KETER_CACHE", None)
+        else:
+            os.environ["KETER_CACHE"] = old_cache
+
+
+def benchmark_tokenizer(molecules=500000, repeat=3):
+    from time import perf_counter
+    from keter.operations import smiles2lang, pack_smiles, tokenize_smiles_batch
+
+    rng = np.random.default_rng(18)
+    smiles = _synthetic_smiles(rng, molecules)
+
+    def per_molecule():
+        return [smiles2lang(molecule) for molecule in smiles]
+
+    def batch():
+        return tokenize_smiles_batch(*pack_smiles(smiles))
+
+    timings = {}
+    results = {}
+    for name, tokenize in (("smiles2lang", per_molecule), ("batch", batch)):
+        times = []
+        for _ in range(repeat):
+            start = perf_counter()
+            results[name] = tokenize()
+            times.append(perf_counter() - start)
+        timings[name] = min(times)
+        print(f"{name}: {molecules / timings[name]:,.0f} molecules/s")
+
+    buffer = pack_smiles(smiles)[0].tobytes()
+    starts, ends, indptr = results["batch"]
+    for i in rng.choice(molecules, 1000):
+        sentence = " ".join(
+            buffer[starts[j] : ends[j]].decode()
+            for j in range(indptr[i], indptr[i + 1])
+        )
+        assert sentence == results["smiles2lang"][i]
+    print(f"Identical tokens, {timings['smiles2lang'] / timings['batch']:.1f}x faster")
+
+
+def benchmark_token_ids(molecules=200000, max_ngram=4, max_vocab=5000, workers=None):
+    from time import perf_counter
+    from sklearn.feature_extraction.text import CountVectorizer
+    from keter.operations import generate_smiles2lang
+    from keter.models.tokens import TokenIndex, TOKEN_PATTERN
+
+    rng = np.random.default_rng(18)
+    smiles = _synthetic_smiles(rng, molecules)
+
+    cv = CountVectorizer(
+        lowercase=False,
+        ngram_range=(1, max_ngram),
+        max_features=max_vocab,
+        token_pattern=TOKEN_PATTERN,
+    )
+    cv.fit(generate_smiles2lang(smiles[:10000]))
+    vocab = set(cv.get_feature_names_out())
+    analyzer = cv.build_analyzer()
+
+    start = perf_counter()
+    strings = [
+        [token.replace(" ", "A") for token in analyzer(sentence) if token in vocab]
+        for sentence in generate_smiles2lang(smiles)
+    ]
+    strings_time = perf_counter() - start
+    print(f"strings: {molecules / strings_time:,.0f} molecules/s")
+
+    index = TokenIndex(vocab, max_ngram)
+    start = perf_counter()
+    features, indptr = index.encode(smiles, workers=1)
+    ids_time = perf_counter() - start
+    print(f"token ids: {molecules / ids_time:,.0f} molecules/s")
+
+    start = perf_counter()
+    parallel_features, parallel_indptr = index.encode(smiles, workers)
+    parallel_time = perf_counter() - start
+    print(f"token ids in parallel: {molecules / parallel_time:,.0f} molecules/s")
+    assert np.array_equal(features, parallel_features)
+    assert np.array_equal(indptr, parallel_indptr)
+
+    for i in rng.choice(molecules, 1000):
+        assert index.names[features[indptr[i] : indptr[i + 1]]].tolist() == strings[i]
+    print(f"Identical features, {strings_time / ids_time:.1f}x faster")
+
+
+def benchmark_vocabulary_selection(
+    molecules=5000, labels=12, max_ngram=4, max_vocab=5000, workers=None
+):
+    from time import perf_counter
+    import pandas as pd
+    from sklearn.feature_extraction.text import CountVectorizer
+    from sklearn.feature_selection import mutual_info_classif
+    from keter.operations import generate_smiles2lang
+    from keter.models.tokens import TOKEN_PATTERN
+    from keter.models.vocabulary import mutual_information
+
+    rng = np.random.default_rng(18)
+    smiles = _synthetic_smiles(rng, molecules)
+    # Tox21 style labels, active, inactive or unknown
+    Y = pd.DataFrame(
+        {f"label_{i}": rng.choice([0, 1, -1], molecules) for i in range(labels)}
+    )
+
+    cv = CountVectorizer(
+        max_df=0.95,
+        min_df=2,
+        lowercase=False,
+        ngram_range=(1, max_ngram),
+        max_features=max_vocab,
+        token_pattern=TOKEN_PATTERN,
+    )
+    X_vec = cv.fit_transform(generate_smiles2lang(smiles))
+
+    start = perf_counter()
+    per_label = np.stack(
+        [mutual_info_classif(X_vec, Y[i], discrete_features=True) for i in Y],
+        axis=1,
+    )
+    per_label_time = perf_counter() - start
+    print(f"mutual_info_classif per label: {per_label_time:.2f}s")
+
+    start = perf_counter()
+    batched = mutual_information(X_vec, Y, workers=1)
+    batched_time = perf_counter() - start
+    print(f"batched: {batched_time:.2f}s")
+
+    start = perf_counter()
+    parallel = mutual_information(X_vec, Y, workers)
+    print(f"batched in parallel: {perf_counter() - start:.2f}s")
+
+    assert np.allclose(per_label, batched, rtol=0, atol=1e-12)
+    assert np.array_equal(batched, parallel)
+    print(f"Identical scores, {per_label_time / batched_time:.1f}x faster")
+
+
+def benchmark_doc2vec_inference(molecules=20000, epochs=300, workers=None):
+    from time import perf_counter
+    import pandas as pd
+    from keter.models.vectors import (
+        ChemicalLanguageModule,
+        ChemicalLanguageHyperparameters,
+    )
+
+    rng = np.random.default_rng(18)
+    smiles = _synthetic_smiles(rng, molecules)
+    Y = pd.DataFrame({"label": rng.integers(0, 2, molecules)})
+
+    # A small model, inference cost is set by the epochs of the doc2vec mode
+    model = ChemicalLanguageModule(
+        ChemicalLanguageHyperparameters.from_dict(
+            {"doc_epochs": 1, "vec_dims": 512, "max_vocab": 5000, "token_ids": True}
+        )
+    )
+    model.fit(smiles[:5000], smiles[:5000], Y[:5000])
+    model.document_model.epochs = epochs
+
+    model.workers = 1
+    start = perf_counter()
+    serial = model.to_vecs(smiles[:1000])
+    serial_time = perf_counter() - start
+    print(f"serial: {1000 / serial_time:,.1f} molecules/s")
+
+    model.workers = workers
+    start = perf_counter()
+    sharded = model.to_vecs(smiles)
+    sharded_time = perf_counter() - start
+    print(f"sharded: {molecules / sharded_time:,.1f} molecules/s")
+
+    assert np.array_equal(serial, sharded[:1000])
+    speedup = (molecules / sharded_time) / (1000 / serial_time)
+    print(f"Identical vectors, {speedup:.1f}x faster")
+
+
+def benchmark_lda_inference(molecules=50000, topics=1000, workers=None):
+    from time import perf_counter
+    import pandas as pd
+    from keter.models.vectors import (
+        ChemicalLanguageModule,
+        ChemicalLanguageHyperparameters,
+    )
+
+    rng = np.random.default_rng(18)
+    smiles = _synthetic_smiles(rng, molecules)
+    Y = pd.DataFrame({"label": rng.integers(0, 2, molecules)})
+
+    model = ChemicalLanguageModule(
+        ChemicalLanguageHyperparameters.from_dict(
+            {"vector_algo": "lda", "topics": topics, "token_ids": True}
+        )
+    )
+    model.workers = workers
+    start = perf_counter()
+    model.fit(smiles[:10000], smiles[:10000], Y[:10000])
+    print(f"fit on a streamed corpus: {perf_counter() - start:.1f}s")
+
+    model.workers = 1
+    start = perf_counter()
+    serial = model.to_vecs(smiles[:5000])
+    serial_time = perf_counter() - start
+    print(f"serial: {5000 / serial_time:,.1f} molecules/s")
+
+    model.workers = workers
+    start = perf_counter()
+    chunked = model.to_vecs(smiles)
+    chunked_time = perf_counter() - start
+    print(f"chunked: {molecules / chunked_time:,.1f} molecules/s")
+
+    assert chunked.dtype == np.float32
+    assert np.array_equal(serial, chunked[:5000])
+    speedup = (molecules / chunked_time) / (5000 / serial_time)
+    print(f"Identical topics, {speedup:.1f}x faster")
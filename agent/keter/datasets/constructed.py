@@ -1,9 +1,13 @@
-import lzma
+import os
+from pathlib import Path
 from typing import List, Sequence
-from dateutil.parser import parse
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-from keter.stage import cache, get_path
+import pyarrow as pa
+import pyarrow.parquet as pq
+from keter.stage import cache, fingerprint, locate, update
+from keter.datasets.handle import DatasetHandle
 from keter.datasets.raw import (
     Tox21,
     ToxCast,
@@ -18,17 +22,27 @@ from keter.datasets.raw import (
     CoronaDeathsUSA,
     ESOL,
 )
-from keter.operations import construct_infection_records
+from keter.util.chemistry import canonicalize, canonicalize_many
 
 
 class ConstructedData:
+    dependencies = ()
+
+    def key(self) -> str:
+        return fingerprint(self.construct, *(dep.key() for dep in self.dependencies))
+
     def to_df(self) -> pd.DataFrame:
         name = self.filename + ".parquet"
-        return cache("constructed", name, self.construct)
+        return cache("constructed", name, self.construct, key=self.key())
+
+    def scan(self, columns: Sequence[str] = None) -> DatasetHandle:
+        name = self.filename + ".parquet"
+        return DatasetHandle("constructed", name, self.construct, self.key(), columns)
 
 
 class Safety(ConstructedData):
     filename = "safety"
+    dependencies = (Tox21(), ToxCast())
 
     def construct(self) -> pd.DataFrame:
         dataframe = pd.merge(
@@ -59,10 +73,11 @@ class Safety(ConstructedData):
 
 class Feasibility(ConstructedData):
     filename = "feasibility"
+    dependencies = (ESOL(),)
 
     def construct(self) -> pd.DataFrame:
-        esol = ESOL().to_df()
         esol_ylabel = "ESOL predicted log solubility in mols per litre"
+        esol = ESOL().scan(["smiles", esol_ylabel]).to_df()
 
         # Normalize feasibility score
         min_val = esol[esol_ylabel].min()
@@ -76,6 +91,17 @@ class Feasibility(ConstructedData):
 
 class Unlabeled(ConstructedData):
     filename = "unlabeled"
+    dependencies = (
+        Moses(),
+        ToxCast(),
+        Tox21(),
+        Bbbp(),
+        Muv(),
+        Sider(),
+        ClinTox(),
+        Pcba(),
+        Lipophilicity(),
+    )
 
     def to_list(self) -> List[str]:
         return self.to_df()["smiles"].tolist()
@@ -84,16 +110,19 @@ class Unlabeled(ConstructedData):
         dataframe = (
             pd.concat(
                 [
-                    Moses().to_df()[["SMILES"]].rename(columns={"SMILES": "smiles"}),
-                    ToxCast().to_df()[["smiles"]],
-                    Tox21().to_df()[["smiles"]],
-                    Bbbp().to_df()[["smiles"]],
-                    Muv().to_df()[["smiles"]],
-                    Sider().to_df()[["smiles"]],
-                    ClinTox().to_df()[["smiles"]],
-                    Pcba().to_df()[["smiles"]],
-                    Bbbp().to_df()[["smiles"]],
-                    Lipophilicity().to_df()[["smiles"]],
+                    Moses()
+                    .scan(["SMILES"])
+                    .to_df()
+                    .rename(columns={"SMILES": "smiles"}),
+                    ToxCast().scan(["smiles"]).to_df(),
+                    Tox21().scan(["smiles"]).to_df(),
+                    Bbbp().scan(["smiles"]).to_df(),
+                    Muv().scan(["smiles"]).to_df(),
+                    Sider().scan(["smiles"]).to_df(),
+                    ClinTox().scan(["smiles"]).to_df(),
+                    Pcba().scan(["smiles"]).to_df(),
+                    Bbbp().scan(["smiles"]).to_df(),
+                    Lipophilicity().scan(["smiles"]).to_df(),
                 ]
             )
             .drop_duplicates()
@@ -102,43 +131,377 @@ class Unlabeled(ConstructedData):
         return dataframe
 
 
+class CanonicalUnlabeled(Unlabeled):
+    """
+    Unlabeled corpus with every molecule canonicalized by RDKit and deduplicated by
+    InChIKey, so different spellings of one molecule appear once. Each source is
+    canonicalized into its own cached partition. When a source changes, only its
+    partition is rebuilt before the partitions are combined again.
+    """
+
+    filename = "unlabeled_canonical"
+    # Processes canonicalizing molecules, defaults to one per core
+    workers = None
+
+    def _partition(self, source) -> pd.DataFrame:
+        column = "SMILES" if isinstance(source, Moses) else "smiles"
+
+        def canonicalize_source() -> pd.DataFrame:
+            smiles = source.scan([column]).to_df()[column].dropna().drop_duplicates()
+            return (
+                pd.DataFrame(
+                    canonicalize_many(smiles.tolist(), self.workers),
+                    columns=["smiles", "key"],
+                )
+                .dropna()
+                .drop_duplicates(subset=["key"])
+                .reset_index(drop=True)
+            )
+
+        return cache(
+            "constructed",
+            f"{self.filename}/{source.filename}.parquet",
+            canonicalize_source,
+            key=fingerprint(canonicalize, source.key()),
+        )
+
+    def construct(self) -> pd.DataFrame:
+        return (
+            pd.concat([self._partition(source) for source in self.dependencies])
+            .drop_duplicates(subset=["key"])
+            .reset_index(drop=True)
+        )
+
+
+def generate_infections(
+    date: int,
+    deaths: np.ndarray,
+    uids: np.ndarray,
+    lats: np.ndarray,
+    longs: np.ndarray,
+    seed: int,
+    infections_per_death: int,
+) -> pd.DataFrame:
+    """
+    Simulates the infections behind one day of reported deaths as columnar
+    records. Every county draws from its own generator seeded by (seed, county,
+    date), so any partitioning of the work produces the same records.
+    """
+    counts = np.clip(np.nan_to_num(deaths), 0, None).astype(np.int64)
+    counts *= infections_per_death
+    offsets = np.cumsum(counts) - counts
+
+    timestamp = np.empty(counts.sum(), dtype=np.int64)
+    lat = np.empty(counts.sum(), dtype=np.float32)
+    long_ = np.empty(counts.sum(), dtype=np.float32)
+    for i in np.flatnonzero(counts):
+        rng = np.random.default_rng([seed, int(uids[i]), date])
+        start, stop = offsets[i], offsets[i] + counts[i]
+        # Cases happen 12.5 to 15 days before the death is reported,
+        # within about a third of a degree of the county centroid
+        timestamp[start:stop] = date - 1296000 + rng.integers(0, 216001, counts[i])
+        lat[start:stop] = lats[i] + (rng.integers(0, 2000, counts[i]) - 1000) / 3000
+        long_[start:stop] = longs[i] + (rng.integers(0, 2000, counts[i]) - 1000) / 3000
+
+    return pd.DataFrame(
+        {
+            "timestamp": timestamp,
+            "lat": lat,
+            "long": long_,
+            "uid": np.repeat(uids.astype(np.int64), counts),
+        }
+    )
+
+
+def _spread_bits(values: np.ndarray) -> np.ndarray:
+    values = values.astype(np.uint32) & 0xFFFF
+    values = (values | (values << 8)) & 0x00FF00FF
+    values = (values | (values << 4)) & 0x0F0F0F0F
+    values = (values | (values << 2)) & 0x33333333
+    return (values | (values << 1)) & 0x55555555
+
+
+def _zorder(lat: np.ndarray, long_: np.ndarray) -> np.ndarray:
+    """
+    Z-order (Morton) code of coordinates quantized to 16 bits each. Records sorted
+    by it are close in both latitude and longitude, like geohash buckets.
+    """
+    y = np.clip((lat + 90.0) / 180.0 * 0xFFFF, 0, 0xFFFF)
+    x = np.clip((long_ + 180.0) / 360.0 * 0xFFFF, 0, 0xFFFF)
+    return (_spread_bits(y) << 1) | _spread_bits(x)
+
+
+def _write_infection_partition(
+    path: Path, date: int, *args, row_group_size: int = 16384
+) -> List[dict]:
+    """
+    Writes one report date sorted along the Z-order curve, so every row group
+    covers a compact area, and returns the index entries of its row groups.
+    """
+    records = generate_infections(date, *args)
+    records = records.iloc[
+        np.argsort(_zorder(records["lat"].to_numpy(), records["long"].to_numpy()))
+    ]
+    filename = f"{date}.parquet"
+    # Partitions may be added to a live dataset, so they appear in one rename
+    tmp_path = path / f".{filename}.tmp"
+    pq.write_table(
+        pa.Table.from_pandas(records, preserve_index=False),
+        tmp_path,
+        row_group_size=row_group_size,
+    )
+    metadata = pq.ParquetFile(tmp_path).metadata
+    os.replace(tmp_path, path / filename)
+
+    entries = []
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        entry = {"file": filename, "row_group": i, "rows": row_group.num_rows}
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            if column.path_in_schema in ("timestamp", "lat", "long"):
+                entry[f"{column.path_in_schema}_min"] = column.statistics.min
+                entry[f"{column.path_in_schema}_max"] = column.statistics.max
+        entries.append(entry)
+    return entries
+
+
 class InfectionNet:
+    """
+    Synthetic infection records (timestamp, lat, long, uid) derived from the daily
+    county death counts of CoronaDeathsUSA. Stored as a directory with one Parquet
+    partition per report date, written in parallel by worker processes. Records
+    are sorted along a Z-order curve inside each partition, and an index of the
+    time and coordinate ranges of every row group lets range queries read only
+    the blocks they need.
+    """
+
     filename = "infectionnet"
+    # 86 = IFR of about 1.15%
+    infections_per_death = 86
+    seed = 18
+    # Processes generating partitions, defaults to one per core
+    workers = None
+    # Columns of the records as generate_infections writes them
+    schema = pa.schema(
+        [
+            ("timestamp", pa.int64()),
+            ("lat", pa.float32()),
+            ("long", pa.float32()),
+            ("uid", pa.int64()),
+        ]
+    )
+    index_columns = [
+        "file",
+        "row_group",
+        "rows",
+        "timestamp_min",
+        "timestamp_max",
+        "lat_min",
+        "lat_max",
+        "long_min",
+        "long_max",
+    ]
+
+    def key(self) -> str:
+        # New reports are appended in place by update(), so this covers the source
+        # rather than the version of its data
+        return fingerprint(
+            generate_infections,
+            self.infections_per_death,
+            self.seed,
+            CoronaDeathsUSA.url,
+            CoronaDeathsUSA.download,
+        )
+
+    def daily_deaths(self, corona_deaths: pd.DataFrame = None) -> tuple:
+        """
+        Returns county UIDs, latitudes, longitudes, report dates as Unix timestamps
+        and the counties by dates matrix of newly reported deaths.
+        """
+        if corona_deaths is None:
+            corona_deaths = CoronaDeathsUSA().to_df()
+        date_columns = [column for column in corona_deaths.columns if "/" in column]
+        dates = (
+            pd.to_datetime(date_columns, format="%m/%d/%y") - pd.Timestamp(0)
+        ) // pd.Timedelta(seconds=1)
+        deaths = corona_deaths[date_columns].to_numpy(dtype=np.float64)
+        return (
+            corona_deaths["UID"].to_numpy(dtype=np.int64),
+            corona_deaths["Lat"].to_numpy(dtype=np.float64),
+            corona_deaths["Long_"].to_numpy(dtype=np.float64),
+            dates.to_numpy()[1:],
+            np.diff(deaths, axis=1),
+        )
+
+    def _write_partitions(
+        self,
+        path: Path,
+        dates: Sequence[int] = None,
+        corona_deaths: pd.DataFrame = None,
+    ):
+        uids, lats, longs, all_dates, deaths = self.daily_deaths(corona_deaths)
+        path.mkdir(parents=True, exist_ok=True)
+        with ProcessPoolExecutor(self.workers) as executor:
+            futures = [
+                executor.submit(
+                    _write_infection_partition,
+                    path,
+                    int(date),
+                    deaths[:, i],
+                    uids,
+                    lats,
+                    longs,
+                    self.seed,
+                    self.infections_per_death,
+                )
+                for i, date in enumerate(all_dates)
+                if dates is None or date in dates
+            ]
+            entries = [entry for future in futures for entry in future.result()]
+        index = pd.DataFrame(entries, columns=self.index_columns)
+        if dates is not None and (path / "_index.parquet").exists():
+            # Appending partitions keeps the index entries of the other dates
+            existing = pd.read_parquet(path / "_index.parquet")
+            existing = existing[~existing["file"].isin(index["file"])]
+            index = pd.concat([existing, index], ignore_index=True)
+        self._write_index(path, index)
+
+    @staticmethod
+    def _write_index(path: Path, index: pd.DataFrame):
+        # Leading underscore keeps the index out of Parquet dataset reads
+        tmp_path = path / "._index.parquet.tmp"
+        index.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path / "_index.parquet")
+
+    def update(self, refresh: bool = True) -> List[int]:
+        """
+        Generates records only for the report dates that have no partition yet,
+        after downloading the latest CoronaDeathsUSA if refresh is set, and
+        appends them to the dataset and its index. Returns the new dates.
+        """
+        if refresh:
+            corona_deaths = CoronaDeathsUSA().refresh()
+        else:
+            corona_deaths = CoronaDeathsUSA().to_df()
+
+        def append(path: Path) -> List[int]:
+            existing = {partition.stem for partition in path.glob("[!_.]*.parquet")}
+            _, _, _, dates, _ = self.daily_deaths(corona_deaths)
+            new_dates = [int(date) for date in dates if str(date) not in existing]
+            if new_dates:
+                self._write_partitions(path, new_dates, corona_deaths)
+            return new_dates
+
+        # The stage holds the artifact lock for the whole update, so concurrent
+        # updates neither write the same partitions nor lose index entries
+        new_dates = update(
+            "constructed",
+            self.filename + ".parquet",
+            self.construct,
+            append,
+            key=self.key(),
+            writer=self._write_partitions,
+        )
+        # Stages that persist nothing generate the latest records on every read
+        return new_dates or []
+
+    def construct(self) -> pd.DataFrame:
+        uids, lats, longs, dates, deaths = self.daily_deaths()
+        return pd.concat(
+            [
+                generate_infections(
+                    int(date),
+                    deaths[:, i],
+                    uids,
+                    lats,
+                    longs,
+                    self.seed,
+                    self.infections_per_death,
+                )
+                for i, date in enumerate(dates)
+            ],
+            ignore_index=True,
+        )
 
-    # TODO: Respect the stage
-    def to_csv(self) -> Sequence[str]:
-        constructed_data_root = get_path("constructed")
-        csv_file = (constructed_data_root / self.filename).with_suffix(".csv.xz")
-
-        if csv_file.exists():
-            with lzma.open(csv_file, "rt") as fd:
-                for line in fd:
-                    yield line.rstrip()
-                return
-
-        corona_deaths = CoronaDeathsUSA().to_df()
-        corona_deaths = corona_deaths.rename(
-            columns={
-                column: int(parse(column).timestamp())
-                for column in corona_deaths.columns
-                if "/" in column
-            }
+    def to_df(self) -> pd.DataFrame:
+        return cache(
+            "constructed",
+            self.filename + ".parquet",
+            self.construct,
+            key=self.key(),
+            writer=self._write_partitions,
         )
-        timestamp_columns = [
-            column for column in corona_deaths.columns if isinstance(column, int)
+
+    def scan(self, columns: Sequence[str] = None) -> DatasetHandle:
+        return DatasetHandle(
+            "constructed",
+            self.filename + ".parquet",
+            self.construct,
+            self.key(),
+            columns,
+            writer=self._write_partitions,
+        )
+
+    def query(
+        self,
+        lat: tuple = None,
+        long: tuple = None,
+        time: tuple = None,
+        columns: Sequence[str] = None,
+    ) -> pd.DataFrame:
+        """
+        Returns the records inside a bounding box and time window, each given as
+        inclusive (min, max) bounds. Only row groups whose index ranges overlap the
+        query are read.
+        """
+        bounds = {"timestamp": time, "lat": lat, "long": long}
+        bounds = {column: bound for column, bound in bounds.items() if bound}
+        filters = [
+            condition
+            for column, (low, high) in bounds.items()
+            for condition in ((column, ">=", low), (column, "<=", high))
         ]
-        corona_deaths[timestamp_columns] = corona_deaths[timestamp_columns].diff(axis=1)
-        corona_deaths = corona_deaths.dropna(axis=1)
-
-        constructed_data_root.mkdir(parents=True, exist_ok=True)
-        fd = lzma.open(csv_file, "wt")
-        for row in corona_deaths.iterrows():
-            _, series = row
-            for column, val in series.items():
-                if isinstance(column, int):
-                    for record in construct_infection_records(
-                        column, val, series.Lat, series.Long_
-                    ):
-                        fd.write(record + "\n")
-                        yield record
-        fd.close()
\ No newline at end of file
+
+        path = locate(
+            "constructed",
+            self.filename + ".parquet",
+            self.construct,
+            key=self.key(),
+            writer=self._write_partitions,
+        )
+        if path is None:
+            # Stages that do not persist the records can only filter them in memory
+            return DatasetHandle(
+                "constructed",
+                self.filename + ".parquet",
+                self.construct,
+                self.key(),
+                columns,
+                filters,
+            ).to_df()
+
+        index = pd.read_parquet(path / "_index.parquet")
+        overlaps = np.ones(len(index), dtype=bool)
+        for column, (low, high) in bounds.items():
+            overlaps &= (index[f"{column}_max"] >= low).to_numpy()
+            overlaps &= (index[f"{column}_min"] <= high).to_numpy()
+
+        read_columns = None if columns is None else list(set(columns) | set(bounds))
+        tables = [
+            pq.ParquetFile(path / filename).read_row_groups(
+                blocks["row_group"].tolist(), columns=read_columns
+            )
+            for filename, blocks in index[overlaps].groupby("file", sort=False)
+        ]
+        if not tables:
+            # Nothing matched or there are no partitions yet, keep the columns
+            table = self.schema.empty_table()
+            tables = [table.select(read_columns) if read_columns else table]
+        records = pa.concat_tables(tables).to_pandas()
+
+        matches = np.ones(len(records), dtype=bool)
+        for column, (low, high) in bounds.items():
+            matches &= records[column].between(low, high).to_numpy()
+        records = records[matches].reset_index(drop=True)
+        return records if columns is None else records[list(columns)]
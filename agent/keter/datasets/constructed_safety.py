@@ -1,22 +1,29 @@
+import warnings
 from typing import Sequence
 from io import BytesIO
 from zipfile import ZipFile
 from pathlib import Path
 from functools import reduce
-from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import pandas as pd
 import numpy as np
+from scipy.sparse import csr_matrix, issparse
 from tqdm.auto import tqdm
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import roc_auc_score
 from keter.actors.vectors import ChemicalLanguage
-from keter.stage import get_path, cache
+from keter.stage import cache, fingerprint
+from keter.util.transfer import fetch
+from keter.util.shared import SharedArrays, attach
 from keter.datasets.constructed import ConstructedData
 
 
 class Tox21Full(ConstructedData):
     filename = "tox21_full_combined"
+    assay_url = "https://tripod.nih.gov/tox21/assays/download/{assay}.zip"
+    # Assays fetched and parsed at the same time
+    workers = 8
     tox21_assays = [
         "tox21-ahr-p1",
         "tox21-ap1-agonist-p1",
@@ -84,15 +91,23 @@ class Tox21Full(ConstructedData):
         "tox21-vdr-bla-antagonist-p1",
     ]
 
+    def key(self) -> str:
+        return fingerprint(
+            self.construct, self.download, self.assay_url, self.tox21_assays
+        )
+
     def download(self, assay: str):
         if assay not in self.tox21_assays:
             raise ValueError(f"Not a valid Tox21 assay: {assay}")
-        raw_dir = get_path("raw") / "tox21"
-        raw_url = f"https://tripod.nih.gov/tox21/assays/download/{assay}.zip"
-        return urlopen(raw_url).read()
+        return fetch(self.assay_url.format(assay=assay))
 
     def to_df_by_assay(self, assay: str) -> pd.DataFrame:
-        raw = cache("raw", Path("tox21") / f"{assay}.zip", lambda: self.download(assay))
+        raw = cache(
+            "raw",
+            Path("tox21") / f"{assay}.zip",
+            lambda: self.download(assay),
+            key=fingerprint(self.assay_url.format(assay=assay), self.download),
+        )
         raw_fd = BytesIO(raw)
         with ZipFile(raw_fd) as zip_fd:
             for inner_filename in zip_fd.namelist():
@@ -101,17 +116,29 @@ class Tox21Full(ConstructedData):
                         return pd.read_csv(inner_fd, sep="\t", index_col=False)
 
     def to_dfs(self) -> Sequence[pd.DataFrame]:
-        for assay in self.tox21_assays:
-            yield assay, self.to_df_by_assay(assay)
+        # Assays are fetched and parsed concurrently but yielded in order
+        with ThreadPoolExecutor(self.workers) as executor:
+            yield from zip(
+                self.tox21_assays, executor.map(self.to_df_by_assay, self.tox21_assays)
+            )
+
+    @staticmethod
+    def _test_type(assay: str) -> str:
+        if "antagonist" in assay:
+            return "active antagonist"
+        elif "agonist" in assay:
+            return "active agonist"
+        else:
+            return "active "
+
+    @classmethod
+    def _assemble_reference(cls, assay_dfs) -> pd.DataFrame:
+        """
+        Original per-SMILES construction, kept to verify and benchmark _assemble.
+        """
 
-    def construct(self) -> pd.DataFrame:
         def create_assay_df(assay: str, df: pd.DataFrame) -> pd.DataFrame:
-            if "antagonist" in assay:
-                test_type = "active antagonist"
-            elif "agonist" in assay:
-                test_type = "active agonist"
-            else:
-                test_type = "active "
+            test_type = cls._test_type(assay)
 
             def clarify_df(raw_df: pd.DataFrame) -> pd.DataFrame:
                 for name, group in raw_df.groupby("SMILES"):
@@ -125,37 +152,112 @@ class Tox21Full(ConstructedData):
 
             return pd.DataFrame(clarify_df(df), columns=["smiles", assay])
 
-        result = reduce(
+        return reduce(
             lambda left, right: pd.merge(
                 left, right, on="smiles", how="outer", sort=False,
             ),
-            (
-                create_assay_df(assay, df)
-                for assay, df in tqdm(
-                    self.to_dfs(),
-                    total=len(self.tox21_assays),
-                    unit="assay",
-                    desc="[Dataset] Tox21Full",
+            (create_assay_df(assay, df) for assay, df in assay_dfs),
+        )
+
+    @classmethod
+    def _assemble(cls, assay_dfs) -> pd.DataFrame:
+        """
+        Labels the outcomes of every assay in one long frame and pivots it into the
+        wide smiles by assay table with a single groupby.
+        """
+        assays = []
+        labels = []
+        for assay, df in assay_dfs:
+            try:
+                hits = (
+                    df["ASSAY_OUTCOME"]
+                    .str.contains(cls._test_type(assay))
+                    .fillna(False)
+                    .astype(float)
                 )
-            ),
+            except AttributeError:
+                # Outcomes that are not text mark the whole assay as unknown
+                hits = np.full(len(df), np.nan)
+            labels.append(
+                pd.DataFrame(
+                    {"smiles": df["SMILES"], "assay": len(assays), "hit": hits}
+                )
+            )
+            assays.append(assay)
+
+        result = (
+            pd.concat(labels, ignore_index=True)
+            .dropna(subset=["smiles"])
+            .groupby(["smiles", "assay"], sort=True)["hit"]
+            .max()
+            .unstack("assay")
+            .reindex(columns=range(len(assays)))
+        )
+        result.columns = assays
+        return result.rename_axis(None, axis=1).reset_index()
+
+    def construct(self) -> pd.DataFrame:
+        return self._assemble(
+            tqdm(
+                self.to_dfs(),
+                total=len(self.tox21_assays),
+                unit="assay",
+                desc="[Dataset] Tox21Full",
+            )
+        )
+
+
+# Feature matrix shared read-only with the assay scoring workers
+_features = None
+
+
+def _share_features(features) -> dict:
+    # Sparse matrices are shared as their CSR arrays
+    if issparse(features):
+        features = features.tocsr()
+        return {
+            "data": features.data,
+            "indices": features.indices,
+            "indptr": features.indptr,
+            "shape": np.array(features.shape),
+        }
+    return {"features": np.asarray(features)}
+
+
+def _attach_features(spec: dict):
+    global _features
+    arrays = attach(spec)
+    if "indptr" in arrays:
+        _features = csr_matrix(
+            (arrays["data"], arrays["indices"], arrays["indptr"]),
+            shape=tuple(arrays["shape"]),
         )
+    else:
+        _features = arrays["features"]
+
 
-        return result
+def _score_assay(y: np.ndarray) -> float:
+    return Safety._determine_assay_score(_features, y)
 
 
 class Safety(ConstructedData):
     filename = "safety2"
+    # Processes scoring assays at the same time, defaults to one per core
+    workers = None
+
+    dependencies = (Tox21Full(),)
 
     def __init__(self):
-        self.preprocessor = ChemicalLanguage("bow")
+        self.preprocessor = ChemicalLanguage("bow", sparse=True)
+        self.failures = {}
+
+    def key(self) -> str:
+        return fingerprint(super().key(), self.preprocessor.key())
 
-    def _determine_assay_score(self, X: pd.Series, y: pd.Series) -> float:
+    @staticmethod
+    def _determine_assay_score(features, y: np.ndarray) -> float:
         Xt, Xv, yt, yv = train_test_split(
-            self.preprocessor.transform(X),
-            y,
-            test_size=0.15,
-            random_state=18,
-            stratify=y,
+            features, y, test_size=0.15, random_state=18, stratify=y,
         )
 
         model = RandomForestClassifier()
@@ -167,24 +269,36 @@ class Safety(ConstructedData):
     def construct(self) -> dict:
         tox21 = Tox21Full()
         df = tox21.to_df()
-        X = df["smiles"]
+        # Featurize once, every assay is scored against the same matrix
+        features = self.preprocessor.transform(df["smiles"])
         df = df.replace([float("NaN"), 1.0, 0.0], [0.0, 1.0, -1.0])
-        for column in tqdm(
-            df,
-            total=len(tox21.tox21_assays) + 1,
-            unit="assay",
-            desc="[Dataset] Safety",
-        ):
-            if column == "smiles":
-                continue
-            y = df[column]
-            try:
-                score = self._determine_assay_score(X, y)
-                df[column] = df[column] * score
-            except:
-                df = df.drop(columns=column)
+        assays = [column for column in df if column != "smiles"]
+
+        self.failures = {}
+        with SharedArrays(**_share_features(features)) as shared, ProcessPoolExecutor(
+            self.workers, initializer=_attach_features, initargs=(shared.spec,)
+        ) as executor:
+            futures = {
+                executor.submit(_score_assay, df[assay].to_numpy()): assay
+                for assay in assays
+            }
+            for future in tqdm(
+                as_completed(futures),
+                total=len(futures),
+                unit="assay",
+                desc="[Dataset] Safety",
+            ):
+                assay = futures[future]
+                try:
+                    df[assay] = df[assay] * future.result()
+                except Exception as err:
+                    self.failures[assay] = err
+
+        for assay, err in self.failures.items():
+            warnings.warn(f"Dropping assay {assay}, it could not be scored: {err!r}")
+        df = df.drop(columns=list(self.failures))
 
-        df["safety"] = df.sum(axis=1)
+        df["safety"] = df.sum(axis=1, numeric_only=True)
         min_val = df["safety"].min()
         max_val = df["safety"].max()
         df["safety"] = 1 - (df["safety"] - min_val) ** (1 / 2) / np.sqrt(
@@ -0,0 +1,58 @@
+from typing import Callable, Sequence, List, Any
+import pandas as pd
+from keter.stage import scan
+
+
+class DatasetHandle:
+    """
+    Lazy reference to a cached dataset. Nothing is read until to_df is called, and
+    the requested columns and row filters are pushed down into the stage reader.
+    """
+
+    def __init__(
+        self,
+        product: str,
+        name: str,
+        func: Callable,
+        key: str = None,
+        columns: Sequence[str] = None,
+        filters: List = None,
+        writer: Callable = None,
+    ):
+        self.product = product
+        self.name = name
+        self.func = func
+        self.key = key
+        self.columns = list(columns) if columns is not None else None
+        self.filters = list(filters) if filters else []
+        self.writer = writer
+
+    def _replace(self, **kwargs) -> "DatasetHandle":
+        params = {
+            "product": self.product,
+            "name": self.name,
+            "func": self.func,
+            "key": self.key,
+            "columns": self.columns,
+            "filters": self.filters,
+            "writer": self.writer,
+        }
+        params.update(kwargs)
+        return DatasetHandle(**params)
+
+    def select(self, *columns: str) -> "DatasetHandle":
+        return self._replace(columns=columns)
+
+    def where(self, column: str, op: str, value: Any) -> "DatasetHandle":
+        return self._replace(filters=self.filters + [(column, op, value)])
+
+    def to_df(self) -> pd.DataFrame:
+        return scan(
+            self.product,
+            self.name,
+            self.func,
+            columns=self.columns,
+            filters=self.filters or None,
+            key=self.key,
+            writer=self.writer,
+        )
@@ -1,21 +1,186 @@
-from functools import reduce
+from typing import Optional, Sequence, Tuple
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from urllib.parse import urlparse
+import gzip
 import pandas as pd
-from keter.stage import cache
+import pyarrow as pa
+import pyarrow.parquet as pq
+from keter.stage import cache, fingerprint, refresh, get_path
+from keter.util.transfer import mirror, read_mirror_manifest
+from keter.datasets.handle import DatasetHandle
 
 
 class RawData:
+    # Rows per chunk when streaming the source straight into Parquet row groups.
+    # Large sources set this so ingest memory stays bounded.
+    chunksize = None
+
+    def key(self) -> str:
+        # Covers the source data, so refreshed data gets a new key. The source is
+        # fetched first, a cold cache would otherwise key the data it builds on None
+        if self.version() is None:
+            self.fetch()
+        return fingerprint(self.url, self.download, self.version())
+
+    def _writer(self):
+        return self.ingest if self.chunksize else None
+
     def to_df(self) -> pd.DataFrame:
         name = self.filename + ".parquet"
-        return cache("raw", name, self.download)
+        return cache("raw", name, self.download, key=self.key(), writer=self._writer())
+
+    def refresh(self) -> pd.DataFrame:
+        """
+        Revalidates the source and rebuilds the cached copy if it changed, for
+        sources that are updated in place upstream such as daily time series.
+        """
+        name = self.filename + ".parquet"
+        if not self.fetch():
+            return self.to_df()
+        return refresh(
+            "raw", name, self.download, key=self.key(), writer=self._writer()
+        )
+
+    def scan(self, columns: Sequence[str] = None) -> DatasetHandle:
+        name = self.filename + ".parquet"
+        return DatasetHandle(
+            "raw", name, self.download, self.key(), columns, writer=self._writer()
+        )
+
+    def source_path(self) -> Path:
+        """
+        Local copy of the source file. Sources given as local paths are used as is.
+        """
+        parsed = urlparse(self.url)
+        if parsed.scheme in ("http", "https"):
+            return get_path("raw") / "sources" / Path(parsed.path).name
+        return Path(parsed.path)
+
+    def fetch(self) -> bool:
+        """
+        Brings the local copy of the source up to date, transferring only what
+        changed or is missing. Returns whether the local copy changed.
+        """
+        if urlparse(self.url).scheme not in ("http", "https"):
+            return False
+        return mirror(self.url, self.source_path())
+
+    def version(self) -> Optional[str]:
+        """
+        Identity of the source data: the checksum of the mirrored copy, or the size
+        and modification time of a local file. It changes when a refresh brings in
+        new data, unlike key(). None until the source has been fetched.
+        """
+        path = self.source_path()
+        if urlparse(self.url).scheme in ("http", "https"):
+            manifest = read_mirror_manifest(path)
+            return manifest.get("sha256") if manifest.get("complete") else None
+        if path.exists():
+            stat = path.stat()
+            return f"{stat.st_size}-{stat.st_mtime_ns}"
+        return None
+
+    def _local_source(self) -> Path:
+        path = self.source_path()
+        if not path.exists():
+            self.fetch()
+        return path
 
     def download(self) -> pd.DataFrame:
         # All raw data uses CSV at this time
         if ".csv" in self.url:
-            dataframe = pd.read_csv(self.url)
+            dataframe = pd.read_csv(self._local_source())
         else:
             raise EnvironmentError("Only CSV is supported for raw data.")
         return dataframe
 
+    def _open_source(self):
+        fd = open(self._local_source(), "rb")
+        if self.url.endswith(".gz"):
+            fd = gzip.GzipFile(fileobj=fd)
+        return fd
+
+    @staticmethod
+    def _chunk_table(chunk: pd.DataFrame) -> pa.Table:
+        # Columns without a value in this chunk say nothing about their type
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        for i, column in enumerate(table.columns):
+            if column.null_count == len(column):
+                table = table.set_column(i, table.field(i).name, pa.nulls(len(table)))
+        return table.replace_schema_metadata()
+
+    def _spill(self, spill_dir: Path, dtype: dict = None) -> list:
+        # Every chunk is written with the types pandas infers for it alone
+        spills = []
+        with self._open_source() as fd:
+            try:
+                chunks = pd.read_csv(
+                    fd, chunksize=self.chunksize or 100000, dtype=dtype
+                )
+                for i, chunk in enumerate(chunks):
+                    spills.append(spill_dir / f"{i}.parquet")
+                    pq.write_table(self._chunk_table(chunk), spills[-1])
+            except pd.errors.EmptyDataError:
+                pass
+        return spills
+
+    @staticmethod
+    def _unify(spills: list) -> Tuple[pa.Schema, list]:
+        """
+        Promotes the column types of the spilled chunks to one schema, for example
+        integers with missing values to floats. Returns the columns whose types
+        cannot be promoted alongside.
+        """
+        schemas = [pq.read_schema(spill) for spill in spills]
+        fields = []
+        conflicts = []
+        for name in schemas[0].names:
+            try:
+                unified = pa.unify_schemas(
+                    [pa.schema([schema.field(name)]) for schema in schemas],
+                    promote_options="permissive",
+                )
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                conflicts.append(name)
+                continue
+            field = unified.field(name)
+            # Columns empty in every chunk are read as floats, as pandas does
+            if pa.types.is_null(field.type):
+                field = field.with_type(pa.float64())
+            fields.append(field)
+        return pa.schema(fields), conflicts
+
+    def ingest(self, path: Path):
+        """
+        Streams the CSV source into Parquet row groups of chunksize rows, without
+        ever holding the full DataFrame in memory. Chunks are spilled with their own
+        types first, then written with the types promoted across all of them, so
+        the columns get the types a read of the whole file would give them.
+        """
+        if ".csv" not in self.url:
+            raise EnvironmentError("Only CSV is supported for raw data.")
+
+        with TemporaryDirectory(prefix=".", dir=path.parent) as spill_dir:
+            spills = self._spill(Path(spill_dir))
+            if not spills:
+                # An empty source still makes an artifact, with whatever header it has
+                with self._open_source() as fd:
+                    try:
+                        pd.read_csv(fd, nrows=0).to_parquet(path)
+                    except pd.errors.EmptyDataError:
+                        pd.DataFrame().to_parquet(path)
+                return
+
+            schema, conflicts = self._unify(spills)
+            if conflicts:
+                # Numbers in some chunks and text in others, keep those as text
+                spills = self._spill(Path(spill_dir), dict.fromkeys(conflicts, str))
+                schema, _ = self._unify(spills)
+            with pq.ParquetWriter(path, schema) as writer:
+                for spill in spills:
+                    writer.write_table(pq.read_table(spill).cast(schema))
+
 
 class Tox21(RawData):
     filename = "tox21_challenge"
@@ -45,6 +210,7 @@ class Bbbp(RawData):
 class Pcba(RawData):
     filename = "pcba"
     url = "https://deepchemdata.s3-us-west-1.amazonaws.com/datasets/pcba.csv.gz"
+    chunksize = 100000
 
 
 class Muv(RawData):
@@ -72,6 +238,7 @@ class ESOL(RawData):
 class Moses(RawData):
     filename = "moses"
     url = "https://github.com/molecularsets/moses/raw/master/data/dataset_v1.csv"
+    chunksize = 250000
 
 
 class CoronaDeathsUSA(RawData):
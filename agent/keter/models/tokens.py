@@ -0,0 +1,212 @@
+import os
+import re
+from collections import deque
+from typing import Iterable, Iterator, Sequence, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor
+import numpy as np
+from scipy.sparse import csr_matrix
+from keter.operations import (
+    smiles2lang,
+    pack_smiles,
+    tokenize_smiles_batch,
+    split_tokens,
+    hash_tokens,
+    lookup_keys,
+    select_ngrams,
+)
+
+# Token pattern of the CountVectorizer that selects the chemical vocabulary
+TOKEN_PATTERN = "[a-zA-Z0-9$&+,:;=?@_/~#\\[\\]|<>.^*()%!-]+"
+
+
+def _allowed_bytes(token_pattern: str) -> np.ndarray:
+    # The pattern is a single ASCII character class, so it is a byte lookup table
+    character = re.compile(token_pattern)
+    allowed = np.zeros(256, dtype=np.uint8)
+    for byte in range(128):
+        allowed[byte] = bool(character.fullmatch(chr(byte)))
+    return allowed
+
+
+def _hash_strings(strings: Sequence[str]) -> np.ndarray:
+    buffer, offsets = pack_smiles(strings)
+    return hash_tokens(buffer, offsets[:-1], offsets[1:])
+
+
+def _map_bounded(executor: Executor, func, chunks: Iterator, window: int):
+    # Chunks are cut and submitted as results are taken, never more than window
+    pending = deque()
+    try:
+        for chunk in chunks:
+            pending.append(executor.submit(func, chunk))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def map_chunks(
+    func,
+    items: Sequence,
+    workers: int = None,
+    chunk_size: int = 20000,
+    executor: Executor = None,
+):
+    """
+    Applies func to consecutive chunks of items in worker processes and yields the
+    results in order, with at most two chunks per worker in flight. Callers that
+    map many sequences can pass an executor to reuse, otherwise a pool is started
+    for the call. Runs in this process when there is one chunk or one worker.
+    """
+    workers = workers or os.cpu_count()
+    chunks = (items[i : i + chunk_size] for i in range(0, len(items), chunk_size))
+    if len(items) <= chunk_size or workers == 1:
+        yield from map(func, chunks)
+    elif executor is not None:
+        yield from _map_bounded(executor, func, chunks, 2 * workers)
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            yield from _map_bounded(executor, func, chunks, 2 * workers)
+
+
+def _smiles2lang_chunk(smiles_seq: Sequence[str]) -> list:
+    return [smiles2lang(smiles) for smiles in smiles_seq]
+
+
+def generate_sentences(
+    smiles_seq: Sequence[str], workers: int = None, chunk_size: int = 20000
+) -> Iterator[str]:
+    """
+    Parallel, order preserving version of generate_smiles2lang.
+    """
+    for sentences in map_chunks(_smiles2lang_chunk, smiles_seq, workers, chunk_size):
+        yield from sentences
+
+
+def _hash_table(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    Open addressing table from keys to their positions, at most half full, probed
+    with Fibonacci hashing and linear probing by the compiled lookups.
+    """
+    bits = max(4, int(2 * len(keys) - 1).bit_length())
+    shift = 64 - bits
+    table_keys = np.zeros(2 ** bits, dtype=np.uint64)
+    table_values = np.full(2 ** bits, -1, dtype=np.int64)
+    mask = 2 ** bits - 1
+    for value, key in enumerate(keys.tolist()):
+        slot = ((key * 11400714819323198485) % 2 ** 64) >> shift
+        while table_values[slot] >= 0:
+            if table_keys[slot] == key:
+                raise ValueError("Duplicate key in hash table")
+            slot = (slot + 1) & mask
+        table_keys[slot] = key
+        table_values[slot] = value
+    return table_keys, table_values, shift
+
+
+class TokenIndex:
+    """
+    Interned integer representation of a selected chemical vocabulary. Tokens are
+    ids into a fixed token array and n-grams are integer codes built from their
+    token ids, so SMILES are turned into vocabulary ids by the compiled tokenizer
+    without creating a Python string per token or n-gram.
+    """
+
+    def __init__(
+        self,
+        vocab: Iterable[str],
+        max_ngram: int,
+        token_pattern: str = TOKEN_PATTERN,
+        chunk_size: int = 20000,
+    ):
+        grams = [gram.split(" ") for gram in vocab]
+        self.max_ngram = max_ngram
+        self.chunk_size = chunk_size
+        self.allowed = _allowed_bytes(token_pattern)
+
+        # Token ids start at 1, 0 is every token outside the vocabulary
+        self.tokens = np.array(sorted({token for gram in grams for token in gram}))
+        self._token_table = _hash_table(_hash_strings(self.tokens))
+        self.base = np.uint64(len(self.tokens) + 1)
+
+        ids = {token: i + 1 for i, token in enumerate(self.tokens)}
+        codes = np.empty(len(grams), dtype=np.uint64)
+        with np.errstate(over="ignore"):
+            for i, gram in enumerate(grams):
+                code = np.uint64(0)
+                for token in gram:
+                    code = code * self.base + np.uint64(ids[token])
+                codes[i] = code
+        order = np.argsort(codes)
+        self.codes = codes[order]
+        if len(np.unique(self.codes)) != len(self.codes):
+            raise ValueError("Vocabulary n-gram codes collide, lower max_ngram")
+        self._code_table = _hash_table(self.codes)
+        # Feature names as the document models know them, interned once
+        self.names = np.array([gram.replace(" ", "A") for gram in vocab], dtype=object)[
+            order
+        ]
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def _encode_chunk(self, smiles_seq: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        buffer, offsets = pack_smiles(smiles_seq)
+        starts, ends, indptr = split_tokens(
+            buffer, *tokenize_smiles_batch(buffer, offsets), self.allowed
+        )
+
+        ids = lookup_keys(hash_tokens(buffer, starts, ends), *self._token_table, -1)
+        return select_ngrams(
+            ids + 1, indptr, self.max_ngram, self.base, *self._code_table
+        )
+
+    def encode(
+        self, smiles_seq: Sequence[str], workers: int = None, executor: Executor = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the vocabulary ids of every document in CSR layout, features and
+        indptr, in the order the string analyzer produces them. Chunks of documents
+        are encoded by worker processes, one per core by default, or by executor.
+        """
+        chunks = list(
+            map_chunks(
+                self._encode_chunk, smiles_seq, workers, self.chunk_size, executor
+            )
+        )
+        if not chunks:
+            return np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64)
+        features = np.concatenate([chunk[0] for chunk in chunks])
+        indptr = [np.zeros(1, dtype=np.int64)]
+        for _, chunk_indptr in chunks:
+            indptr.append(chunk_indptr[1:] + indptr[-1][-1])
+        return features, np.concatenate(indptr)
+
+    def bow(
+        self, smiles_seq: Sequence[str], workers: int = None, executor: Executor = None
+    ) -> csr_matrix:
+        """
+        Bag of words counts of the documents as a sparse documents by vocabulary
+        matrix.
+        """
+        features, indptr = self.encode(smiles_seq, workers, executor)
+        counts = csr_matrix(
+            (np.ones(len(features), dtype=np.float32), features, indptr),
+            shape=(len(indptr) - 1, len(self)),
+        )
+        counts.sum_duplicates()
+        return counts
+
+    def documents(
+        self, smiles_seq: Sequence[str], workers: int = None, executor: Executor = None
+    ):
+        """
+        Yields the documents as lists of feature names, for the document models.
+        The names are shared with the vocabulary rather than created per token.
+        """
+        features, indptr = self.encode(smiles_seq, workers, executor)
+        for start, stop in zip(indptr[:-1], indptr[1:]):
+            yield self.names[features[start:stop]].tolist()
@@ -1,37 +1,142 @@
+import os
+from copy import copy
 from uuid import uuid4
-from typing import Sequence, Generator
+from functools import partial
+from itertools import islice
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from concurrent.futures import Executor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Sequence, Generator, Iterator
 from multiprocessing import cpu_count
 from gensim.models.doc2vec import Doc2Vec, TaggedDocument
-from gensim.matutils import corpus2dense
+from gensim.matutils import corpus2dense, corpus2csc, Sparse2Corpus
 from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.feature_selection import mutual_info_classif
 from sklearn.metrics import roc_auc_score
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
 import numpy as np
 import pandas as pd
 from keter.operations import generate_smiles2lang
+from keter.models.tokens import (
+    TokenIndex,
+    TOKEN_PATTERN,
+    map_chunks,
+    generate_sentences,
+)
+from keter.models.vocabulary import select_vocabulary
+from keter.util.shared import SharedArrays, attach
 
 
-class _WrapGenerator:
+def _advanced_lang_chunk(analyzer, vocab, smiles_seq: Sequence[str]) -> list:
+    return [
+        [token.replace(" ", "A") for token in analyzer(sent) if token in vocab]
+        for sent in generate_smiles2lang(smiles_seq)
+    ]
+
+
+class _BowCorpus:
     """
-    Creates iterators out of replayable generators. Needed for gensim.
+    Replayable stream of the bags of words of molecules, tokenized a chunk at a
+    time, for gensim models that take several passes over their corpus.
     """
 
-    def __init__(self, func):
-        self.func = func
-        self.generator = func()
+    def __init__(self, module, smiles_seq: Sequence[str], chunk_size: int):
+        self.module = module
+        self.smiles_seq = smiles_seq
+        self.chunk_size = chunk_size
+
+    def __len__(self) -> int:
+        return len(self.smiles_seq)
 
     def __iter__(self):
-        self.generator = self.func()
-        return self
+        # One pool tokenizes every chunk of a pass, it starts its workers on demand
+        with ProcessPoolExecutor(self.module.workers or os.cpu_count()) as executor:
+            for start in range(0, len(self.smiles_seq), self.chunk_size):
+                chunk = self.smiles_seq[start : start + self.chunk_size]
+                yield from self.module._make_bows(chunk, executor)
 
-    def __next__(self):
-        res = next(self.generator)
-        if not res:
-            raise StopIteration
-        else:
-            return res
+
+# Models of the inference workers, their weights attached from shared memory
+_document_model = None
+_topic_model = None
+_latent_vecs = None
+
+
+def _document_weights(document_model) -> dict:
+    # The arrays inference reads, the trained document vectors are not among them
+    weights = {"vectors": document_model.wv.vectors}
+    for name in ("syn1neg", "syn1", "cum_table"):
+        if getattr(document_model, name, None) is not None:
+            weights[name] = getattr(document_model, name)
+    return weights
+
+
+def _strip_document_model(document_model):
+    """
+    Shallow copy of a document model without its weights, cheap to hand to worker
+    processes. Its trained document vectors are dropped altogether.
+    """
+    skeleton = copy(document_model)
+    skeleton.wv = copy(document_model.wv)
+    skeleton.dv = copy(document_model.dv)
+    skeleton.wv.vectors = None
+    skeleton.wv.norms = None
+    skeleton.dv.vectors = np.empty((0, document_model.dv.vector_size), np.float32)
+    skeleton.dv.norms = None
+    for name in _document_weights(document_model):
+        if name != "vectors":
+            setattr(skeleton, name, None)
+    return skeleton
+
+
+def _attach_document_model(skeleton, weights_spec: dict, output_spec: dict):
+    global _document_model, _latent_vecs
+    weights = attach(weights_spec)
+    skeleton.wv.vectors = weights.pop("vectors")
+    for name, weight in weights.items():
+        setattr(skeleton, name, weight)
+    _document_model = skeleton
+    _latent_vecs = attach(output_spec, writable=True)["latent_vecs"]
+
+
+def _infer_vector(document_model, words: list, seed: int) -> np.ndarray:
+    # Inference draws its windows and negative samples from the model's generator
+    document_model.random = np.random.RandomState(seed)
+    return document_model.infer_vector(words)
+
+
+def _infer_document_chunk(start: int, documents: list) -> int:
+    for i, words in enumerate(documents, start):
+        _latent_vecs[i] = _infer_vector(_document_model, words, i)
+    return len(documents)
+
+
+def _strip_topic_model(topic_model):
+    # Inference only reads the exponentiated topics, shared with the workers
+    skeleton = copy(topic_model)
+    skeleton.expElogbeta = None
+    skeleton.state = None
+    return skeleton
+
+
+def _attach_topic_model(skeleton, weights_spec: dict, output_spec: dict):
+    global _topic_model, _latent_vecs
+    skeleton.expElogbeta = attach(weights_spec)["expElogbeta"]
+    _topic_model = skeleton
+    _latent_vecs = attach(output_spec, writable=True)["latent_vecs"]
+
+
+def _infer_topics(topic_model, bow: list, seed: int) -> np.ndarray:
+    # Inference starts from topic weights drawn from the model's generator
+    topic_model.random_state = np.random.RandomState(seed)
+    latent_vecs, _ = topic_model.inference([bow])
+    return latent_vecs[0]
+
+
+def _infer_topic_chunk(start: int, bows: list) -> int:
+    for i, bow in enumerate(bows, start):
+        _latent_vecs[i] = _infer_topics(_topic_model, bow, i)
+    return len(bows)
 
 
 class ChemicalLanguageHyperparameters:
@@ -42,6 +147,8 @@ class ChemicalLanguageHyperparameters:
     # Language hyperparams
     max_ngram = 2
     vector_algo = "doc2vec"
+    # Featurize through integer token ids instead of token strings
+    token_ids = False
 
     # Doc2Vec hyperparmas
     vec_dims = 460
@@ -67,6 +174,16 @@ class ChemicalLanguageModule:
     a surrigate prediction set encoding chemistry semantics.
     """
 
+    # Processes tokenizing chunks of molecules, defaults to one per core
+    workers = None
+    # Molecules per doc2vec and LDA inference task
+    infer_chunk_size = 256
+    topic_chunk_size = 2000
+    # Molecules tokenized at a time when streaming a corpus
+    corpus_chunk_size = 100000
+    # Directory of the doc2vec training corpus file, defaults to the temp directory
+    corpus_dir = None
+
     def __init__(self, hyperparams=ChemicalLanguageHyperparameters()):
         self.hyperparams = hyperparams
         if hyperparams.vector_algo not in set(["doc2vec", "lda", "bow"]):
@@ -74,47 +191,143 @@ class ChemicalLanguageModule:
         self.hyperparams = hyperparams
 
     def _smiles_to_advanced_lang(
-        self, smiles_seq: Generator[str, None, None], training: bool = False
+        self,
+        smiles_seq: Sequence[str],
+        training: bool = False,
+        executor: Executor = None,
     ) -> Generator[str, None, None]:
-        for i, sent in enumerate(smiles_seq):
-            sent: Sequence[str] = self._analyzer(sent)
-            res: Sequence[str] = []
-            for token in sent:
-                if token in self.vocab:
-                    res.append(token.replace(" ", "A"))
+        chunk = partial(_advanced_lang_chunk, self._analyzer, self.vocab)
+        documents = (
+            document
+            for documents in map_chunks(
+                chunk, smiles_seq, self.workers, executor=executor
+            )
+            for document in documents
+        )
+        for i, res in enumerate(documents):
             if training:
                 yield TaggedDocument(words=res, tags=[i])
             else:
                 yield res
 
-    def _make_iterator(
-        self, smiles_seq: Sequence[str], training: bool = False
-    ) -> _WrapGenerator:
-        return _WrapGenerator(
-            lambda: self._smiles_to_advanced_lang(
-                generate_smiles2lang(smiles_seq), training
-            )
-        )
-
-    def make_generator(self, X):
-        return self._smiles_to_advanced_lang(generate_smiles2lang(X))
-
-    def to_vecs(self, X: Sequence[str]) -> np.ndarray:
+    def make_generator(self, X, executor: Executor = None):
+        if self.hyperparams.token_ids:
+            return self.tokens.documents(X, self.workers, executor)
+        return self._smiles_to_advanced_lang(X, executor=executor)
+
+    def _make_bows(self, X: Sequence[str], executor: Executor = None) -> list:
+        if self.hyperparams.token_ids:
+            bows = self.tokens.bow(X, self.workers, executor)
+            return list(Sparse2Corpus(bows, documents_columns=False))
+        return [self.dictionary.doc2bow(i) for i in self.make_generator(X, executor)]
+
+    def to_vecs(self, X: Sequence[str], sparse: bool = False) -> np.ndarray:
+        """
+        Latent vectors of the molecules. Bag of words vectors can be returned as a
+        sparse CSR matrix instead, they are mostly zeros.
+        """
         if self.hyperparams.vector_algo == "lda":
-            bows = [self.dictionary.doc2bow(i) for i in self.make_generator(X)]
-            latent_vecs, _ = self.topic_model.inference(bows)
-            return latent_vecs
+            return self._infer_topic_vecs(X)
         elif self.hyperparams.vector_algo == "doc2vec":
-            # Preallocate memory for performance
-            latent_vecs = np.empty((len(X), self.document_model.vector_size))
+            return self._infer_document_vecs(X)
+        elif self.hyperparams.vector_algo == "bow":
+            if self.hyperparams.token_ids:
+                bows = self.tokens.bow(X, self.workers)
+                return bows if sparse else bows.toarray()
+            bows = self._make_bows(X)
+            if sparse:
+                return corpus2csc(
+                    bows, len(self.dictionary), num_docs=len(X), dtype=np.float32
+                ).T.tocsr()
+            return corpus2dense(bows, len(self.dictionary), len(X)).transpose()
+
+    def _infer_in_workers(
+        self,
+        latent_vecs: np.ndarray,
+        documents: Iterator,
+        chunk_size: int,
+        task,
+        initializer,
+        skeleton,
+        weights: dict,
+    ) -> np.ndarray:
+        """
+        Fills the preallocated latent_vecs with worker processes, which share the
+        model weights read-only and write their chunks of documents into one
+        shared output.
+        """
+        workers = self.workers or os.cpu_count()
+        with SharedArrays(**weights) as shared_weights, SharedArrays(
+            latent_vecs=latent_vecs
+        ) as output:
+            with ProcessPoolExecutor(
+                workers,
+                initializer=initializer,
+                initargs=(skeleton, shared_weights.spec, output.spec),
+            ) as executor:
+                # Bounded number of tasks in flight, so documents stream through
+                pending = set()
+                for start in range(0, len(latent_vecs), chunk_size):
+                    chunk = list(islice(documents, chunk_size))
+                    pending.add(executor.submit(task, start, chunk))
+                    if len(pending) >= 2 * workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                for future in pending:
+                    future.result()
+            latent_vecs[...] = output.arrays["latent_vecs"]
+        return latent_vecs
+
+    def _infer_document_vecs(self, X: Sequence[str]) -> np.ndarray:
+        """
+        Doc2vec vectors of the molecules, inferred in parallel. Every molecule is
+        seeded by its position, so the vectors are the same for any number of
+        workers.
+        """
+        # Preallocate memory for performance
+        latent_vecs = np.empty((len(X), self.document_model.vector_size))
+        documents = iter(self.make_generator(X))
+        workers = self.workers or os.cpu_count()
+
+        if workers == 1 or len(X) <= self.infer_chunk_size:
+            for i, words in enumerate(documents):
+                latent_vecs[i] = _infer_vector(self.document_model, words, i)
+            return latent_vecs
 
-            for i, sent in enumerate(self.make_generator(X)):
-                latent_vecs[i] = self.document_model.infer_vector(sent)
+        return self._infer_in_workers(
+            latent_vecs,
+            documents,
+            self.infer_chunk_size,
+            _infer_document_chunk,
+            _attach_document_model,
+            _strip_document_model(self.document_model),
+            _document_weights(self.document_model),
+        )
 
+    def _infer_topic_vecs(self, X: Sequence[str]) -> np.ndarray:
+        """
+        Topic distributions of the molecules, inferred in parallel from a stream
+        of their bags of words. Seeded by position like the doc2vec vectors.
+        """
+        latent_vecs = np.empty((len(X), self.topic_model.num_topics), np.float32)
+        bows = iter(_BowCorpus(self, X, self.corpus_chunk_size))
+        workers = self.workers or os.cpu_count()
+
+        if workers == 1 or len(X) <= self.topic_chunk_size:
+            for i, bow in enumerate(bows):
+                latent_vecs[i] = _infer_topics(self.topic_model, bow, i)
             return latent_vecs
-        elif self.hyperparams.vector_algo == "bow":
-            bows = [self.dictionary.doc2bow(i) for i in self.make_generator(X)]
-            return corpus2dense(bows, len(self.dictionary), len(X)).transpose()
+
+        return self._infer_in_workers(
+            latent_vecs,
+            bows,
+            self.topic_chunk_size,
+            _infer_topic_chunk,
+            _attach_topic_model,
+            _strip_topic_model(self.topic_model),
+            {"expElogbeta": self.topic_model.expElogbeta},
+        )
 
     def _fit_language(
         self, X_unmapped: Sequence[str], X: Sequence[str], Y: pd.DataFrame
@@ -126,44 +339,67 @@ class ChemicalLanguageModule:
             lowercase=False,
             ngram_range=(1, self.hyperparams.max_ngram),
             max_features=max_featues,
-            token_pattern="[a-zA-Z0-9$&+,:;=?@_/~#\\[\\]|<>.^*()%!-]+",
+            token_pattern=TOKEN_PATTERN,
         )
 
-        X_vec = cv.fit_transform(generate_smiles2lang(X))
+        X_vec = cv.fit_transform(generate_sentences(X, self.workers))
 
-        local_vocab = set()
-        for feat in Y.columns:
-            res = zip(
-                cv.get_feature_names(),
-                mutual_info_classif(X_vec, Y[feat], discrete_features=True),
-            )
-            local_vocab.update(res)
-        self.vocab = {
-            i[0]
-            for i in sorted(local_vocab, key=lambda i: i[1], reverse=True)[
-                : self.hyperparams.max_vocab
-            ]
-        }
+        # Scores every label in one pass rather than one mutual_info_classif each
+        self.vocab = select_vocabulary(
+            X_vec,
+            cv.get_feature_names_out(),
+            Y,
+            self.hyperparams.max_vocab,
+            self.workers,
+        )
 
         self._analyzer = cv.build_analyzer()
+        if self.hyperparams.token_ids:
+            self.tokens = TokenIndex(self.vocab, self.hyperparams.max_ngram)
+
+    def _write_corpus(self, X_unmapped: Sequence[str], path: Path) -> int:
+        """
+        Writes the tokenized molecules as a line based corpus, one molecule per
+        line with space separated tokens, and returns the number of lines.
+        Molecules without tokens in the vocabulary are left out, as gensim skips
+        empty lines. Like _BowCorpus, it tokenizes a chunk at a time with one pool.
+        """
+        documents = 0
+        workers = self.workers or os.cpu_count()
+        with open(path, "w", encoding="utf-8") as corpus, ProcessPoolExecutor(
+            workers
+        ) as executor:
+            for start in range(0, len(X_unmapped), self.corpus_chunk_size):
+                chunk = X_unmapped[start : start + self.corpus_chunk_size]
+                for words in self.make_generator(chunk, executor):
+                    if len(words):
+                        corpus.write(" ".join(words) + "\n")
+                        documents += 1
+        return documents
 
     def _fit_document_model(
         self, X_unmapped: Sequence[str], X: Sequence[str], Y: pd.DataFrame
     ):
-        generator = list(self._make_iterator(X_unmapped, training=True))
-
-        document_model = Doc2Vec(
-            vector_size=self.hyperparams.vec_dims,
-            alpha=self.hyperparams.alpha,
-            workers=max(1, cpu_count() - 2),
-            window=self.hyperparams.vec_window,
-        )
-        document_model.build_vocab(generator)
-        document_model.train(
-            generator,
-            total_examples=len(X_unmapped),
-            epochs=self.hyperparams.doc_epochs,
-        )
+        # Gensim streams a corpus file in its worker threads without holding the
+        # documents in memory. Its tags are corpus line numbers, which are not
+        # molecule positions, but documents are only inferred, never looked up
+        with TemporaryDirectory(dir=self.corpus_dir) as directory:
+            corpus_file = str(Path(directory) / "corpus.txt")
+            documents = self._write_corpus(X_unmapped, corpus_file)
+
+            document_model = Doc2Vec(
+                vector_size=self.hyperparams.vec_dims,
+                alpha=self.hyperparams.alpha,
+                workers=self.workers or max(1, cpu_count() - 2),
+                window=self.hyperparams.vec_window,
+            )
+            document_model.build_vocab(corpus_file=corpus_file)
+            document_model.train(
+                corpus_file=corpus_file,
+                total_examples=documents,
+                total_words=document_model.corpus_total_words,
+                epochs=self.hyperparams.doc_epochs,
+            )
 
         self.document_model = document_model
 
@@ -173,16 +409,22 @@ class ChemicalLanguageModule:
         from gensim.models.ldamulticore import LdaMulticore
         from gensim.corpora.dictionary import Dictionary
 
-        iterator = list(self.make_generator(X_unmapped))
-        bow = Dictionary(iterator)
-
-        docs = [bow.doc2bow(i) for i in iterator]
+        if self.hyperparams.token_ids:
+            # Vocabulary ids are the dictionary, no need to build one from strings
+            id2word = dict(enumerate(self.tokens.names))
+        else:
+            self.dictionary = Dictionary(self.make_generator(X_unmapped))
+            id2word = self.dictionary
 
         if self.hyperparams.vector_algo == "lda":
+            # Molecules are tokenized again on every pass instead of kept in memory
             self.topic_model = LdaMulticore(
-                docs, id2word=bow, num_topics=self.hyperparams.topics, random_state=18
+                _BowCorpus(self, X_unmapped, self.corpus_chunk_size),
+                id2word=id2word,
+                num_topics=self.hyperparams.topics,
+                workers=self.workers,
+                random_state=18,
             )
-        self.dictionary = bow
 
     def fit(self, X_unmapped: Sequence[str], X: Sequence[str], Y: pd.DataFrame):
         self._fit_language(X_unmapped, X, Y)
@@ -0,0 +1,126 @@
+from functools import partial
+from typing import Sequence, Set
+import numpy as np
+import pandas as pd
+from scipy.sparse import csc_matrix, csr_matrix
+from keter.models.tokens import map_chunks
+
+
+class _Columns:
+    """
+    The feature columns of a CSC matrix as a sequence, so map_chunks sends each
+    worker the columns it scores rather than the whole matrix.
+    """
+
+    def __init__(self, X: csc_matrix):
+        self.X = X
+
+    def __len__(self) -> int:
+        return self.X.shape[1]
+
+    def __getitem__(self, columns: slice) -> csc_matrix:
+        return self.X[:, columns]
+
+
+def _mutual_information_chunk(
+    classes: np.ndarray,
+    label_indptr: np.ndarray,
+    X: csc_matrix,
+) -> np.ndarray:
+    documents = X.shape[0]
+    class_counts = np.bincount(classes.ravel(), minlength=label_indptr[-1])
+
+    # One row per distinct nonzero (feature, value) pair, with its documents
+    features = np.repeat(np.arange(X.shape[1]), np.diff(X.indptr))
+    values = X.data.astype(np.int64)
+    keys, rows = np.unique(
+        features * (values.max(initial=0) + 1) + values, return_inverse=True
+    )
+    pair_features = keys // (values.max(initial=0) + 1)
+    value_documents = csr_matrix(
+        (np.ones(len(rows), dtype=np.int64), (rows, X.indices)),
+        shape=(len(keys), documents),
+    )
+
+    # Contingency counts of every (feature, value) against every class of every
+    # label at once, as the value rows times the one-hot encoded labels
+    one_hot = np.zeros((documents, label_indptr[-1]), dtype=np.int64)
+    np.put_along_axis(one_hot, classes, 1, axis=1)
+    nonzero_counts = value_documents @ one_hot
+
+    # The zero value of a feature gets the documents no nonzero value took
+    totals = np.concatenate(
+        [np.zeros((1, label_indptr[-1]), dtype=np.int64), nonzero_counts.cumsum(axis=0)]
+    )
+    first = np.searchsorted(pair_features, np.arange(X.shape[1]), side="left")
+    last = np.searchsorted(pair_features, np.arange(X.shape[1]), side="right")
+    zero_counts = class_counts - (totals[last] - totals[first])
+    counts = np.concatenate([nonzero_counts, zero_counts])
+    count_features = np.concatenate([pair_features, np.arange(X.shape[1])])
+    value_totals = counts[:, : label_indptr[1]].sum(axis=1)
+
+    # The terms of sklearn's mutual_info_score, including its epsilon cut-off
+    with np.errstate(divide="ignore", invalid="ignore"):
+        share = counts / documents
+        outer = value_totals[:, None] * class_counts[None, :]
+        terms = share * (np.log(counts) - np.log(documents)) + share * (
+            -np.log(outer) + np.log(documents) + np.log(documents)
+        )
+    terms[counts == 0] = 0.0
+    terms[np.abs(terms) < np.finfo(terms.dtype).eps] = 0.0
+
+    order = np.argsort(count_features, kind="stable")
+    feature_starts = np.searchsorted(count_features[order], np.arange(X.shape[1]))
+    mi = np.add.reduceat(terms[order], feature_starts, axis=0)
+    mi = np.add.reduceat(mi, label_indptr[:-1], axis=1)
+
+    # Features with a single value and labels with a single class carry nothing
+    distinct_values = np.add.reduceat(
+        (value_totals[order] > 0).astype(np.int64), feature_starts
+    )
+    mi[distinct_values <= 1] = 0.0
+    mi[:, np.diff(label_indptr) <= 1] = 0.0
+    return np.clip(mi, 0.0, None)
+
+
+def mutual_information(X, Y: pd.DataFrame, workers: int = 1) -> np.ndarray:
+    """
+    Mutual information between every discrete (count) feature of X and every
+    label column of Y, as a features by labels matrix. It matches calling
+    mutual_info_classif(X, Y[label], discrete_features=True) per label, but the
+    contingency counts of all labels come out of one sparse product. Chunks of
+    features are scored by worker processes, defaults to one.
+    """
+    X = csc_matrix(X)
+    X.eliminate_zeros()
+    codes = [pd.factorize(Y[label], sort=True)[0] for label in Y.columns]
+    # Missing labels get code -1, which would count them in the previous label
+    if any((code < 0).any() for code in codes):
+        raise ValueError("Labels must not contain missing values")
+    label_indptr = np.concatenate([[0], np.cumsum([code.max() + 1 for code in codes])])
+    classes = np.stack(codes, axis=1) + label_indptr[:-1]
+
+    chunk = partial(_mutual_information_chunk, classes, label_indptr)
+    return np.concatenate(
+        list(map_chunks(chunk, _Columns(X), workers, chunk_size=2000))
+    )
+
+
+def select_vocabulary(
+    X,
+    feature_names: Sequence[str],
+    Y: pd.DataFrame,
+    max_vocab: int,
+    workers: int = 1,
+) -> Set[str]:
+    """
+    Features with the highest mutual information with any label. Like the
+    original selection, every distinct (feature, score) pair competes for the
+    max_vocab places, so a feature that scores high for several labels can take
+    several of them.
+    """
+    mi = mutual_information(X, Y, workers)
+    features = np.repeat(np.arange(mi.shape[0]), mi.shape[1])
+    pairs = pd.DataFrame({"feature": features, "mi": mi.ravel()}).drop_duplicates()
+    top = pairs.sort_values("mi", ascending=False, kind="stable")[:max_vocab]
+    return {feature_names[i] for i in top["feature"]}
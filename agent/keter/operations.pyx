@@ -1,25 +1,8 @@
-from libc.stdlib cimport rand
-from typing import Sequence, Generator
+from typing import Sequence, Generator, Tuple
 import numpy as np
 import cython
 
 
-def construct_infection_records(
-    date: cython.int, deaths: cython.int, lat: cython.float, long_: cython.float
-) -> list:
-    res: list = []
-    # 86 = IFR of about 1.15%
-    infections = deaths * 86
-    for i in range(infections):
-        # 216000 = 2.5 days in seconds
-        # 1296000 = 15 days in seconds
-        case_timestamp: cython.int = date + rand() % 216001 - 1296000
-        case_lat: cython.float = lat + (rand() % 2000 - 1000) / 3000
-        case_long: cython.float = long_ + (rand() % 2000 - 1000) / 3000
-        res.append(f"{case_timestamp}, {case_lat}, {case_long}")
-    return res
-
-
 def smiles2lang(smiles: str) -> str:
     """
     High performance SMILES parser that can be compiled into machine code for further speedup.
@@ -66,4 +49,239 @@ def smiles2lang(smiles: str) -> str:
 
 def generate_smiles2lang(smiles_seq: Sequence[str]) -> Generator[str, None, None]:
     for smiles in smiles_seq:
-        yield smiles2lang(smiles)
\ No newline at end of file
+        yield smiles2lang(smiles)
+
+def pack_smiles(smiles_seq: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Packs SMILES into one contiguous UTF-8 buffer, with molecule i stored at
+    buffer[offsets[i]:offsets[i + 1]].
+    """
+    encoded = [smiles.encode() for smiles in smiles_seq]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(smiles) for smiles in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def tokenize_smiles_batch(const unsigned char[::1] buffer, const long long[::1] offsets):
+    """
+    Tokenizes a packed batch of SMILES like smiles2lang, without creating a Python
+    object per token. Every token is a contiguous byte range of the buffer, so
+    they are returned in CSR layout: start and end offsets into the buffer, and an
+    indptr with the tokens of molecule i at indptr[i]:indptr[i + 1].
+    """
+    cdef Py_ssize_t molecules = offsets.shape[0] - 1
+    # A molecule never has more tokens than bytes
+    starts_array = np.empty(buffer.shape[0], dtype=np.int64)
+    ends_array = np.empty(buffer.shape[0], dtype=np.int64)
+    indptr_array = np.empty(molecules + 1, dtype=np.int64)
+    cdef long long[::1] starts = starts_array
+    cdef long long[::1] ends = ends_array
+    cdef long long[::1] indptr = indptr_array
+    cdef Py_ssize_t m, i, stop, bracket_start = 0, count = 0
+    cdef int length
+    cdef unsigned char char
+    cdef bint inbracket
+
+    with nogil:
+        for m in range(molecules):
+            indptr[m] = count
+            i = offsets[m]
+            stop = offsets[m + 1]
+            inbracket = False
+            while i < stop:
+                char = buffer[i]
+                length = 1
+                if inbracket:
+                    # Unterminated brackets are dropped, like in smiles2lang
+                    if char == b"]":
+                        starts[count] = bracket_start
+                        ends[count] = i + 1
+                        count += 1
+                        inbracket = False
+                    i += 1
+                    continue
+                if char == b"[":
+                    bracket_start = i
+                    inbracket = True
+                    i += 1
+                    continue
+                if i + 1 < stop and (
+                    (char == b"C" and buffer[i + 1] == b"l")
+                    or (char == b"B" and buffer[i + 1] == b"r")
+                ):
+                    length = 2
+                elif char >= 0xF0:
+                    length = 4
+                elif char >= 0xE0:
+                    length = 3
+                elif char >= 0xC0:
+                    length = 2
+                starts[count] = i
+                ends[count] = min(i + length, stop)
+                count += 1
+                i += length
+        indptr[molecules] = count
+
+    return starts_array[:count], ends_array[:count], indptr_array
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def split_tokens(
+    const unsigned char[::1] buffer,
+    const long long[::1] starts,
+    const long long[::1] ends,
+    const long long[::1] indptr,
+    const unsigned char[::1] allowed,
+):
+    """
+    Splits tokens into the maximal runs of bytes that allowed marks, like matching
+    a [class]+ token pattern against every token. Takes and returns CSR tokens.
+    """
+    cdef Py_ssize_t documents = indptr.shape[0] - 1
+    run_starts_array = np.empty(buffer.shape[0], dtype=np.int64)
+    run_ends_array = np.empty(buffer.shape[0], dtype=np.int64)
+    run_indptr_array = np.empty(documents + 1, dtype=np.int64)
+    cdef long long[::1] run_starts = run_starts_array
+    cdef long long[::1] run_ends = run_ends_array
+    cdef long long[::1] run_indptr = run_indptr_array
+    cdef Py_ssize_t d, t, i, run_start, count = 0
+
+    with nogil:
+        for d in range(documents):
+            run_indptr[d] = count
+            for t in range(indptr[d], indptr[d + 1]):
+                run_start = -1
+                for i in range(starts[t], ends[t]):
+                    if allowed[buffer[i]]:
+                        if run_start < 0:
+                            run_start = i
+                    elif run_start >= 0:
+                        run_starts[count] = run_start
+                        run_ends[count] = i
+                        count += 1
+                        run_start = -1
+                if run_start >= 0:
+                    run_starts[count] = run_start
+                    run_ends[count] = ends[t]
+                    count += 1
+        run_indptr[documents] = count
+
+    return run_starts_array[:count], run_ends_array[:count], run_indptr_array
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def hash_tokens(
+    const unsigned char[::1] buffer, const long long[::1] starts, const long long[::1] ends
+):
+    """
+    64 bit FNV-1a hashes of the byte ranges of tokens.
+    """
+    hashes_array = np.empty(starts.shape[0], dtype=np.uint64)
+    cdef unsigned long long[::1] hashes = hashes_array
+    cdef unsigned long long value
+    cdef Py_ssize_t t, i
+
+    with nogil:
+        for t in range(starts.shape[0]):
+            value = 14695981039346656037ULL
+            for i in range(starts[t], ends[t]):
+                value = (value ^ buffer[i]) * 1099511628211ULL
+            hashes[t] = value
+
+    return hashes_array
+
+
+cdef inline long long _probe(
+    unsigned long long key,
+    const unsigned long long[::1] keys,
+    const long long[::1] values,
+    int shift,
+) noexcept nogil:
+    cdef Py_ssize_t mask = keys.shape[0] - 1
+    cdef Py_ssize_t slot = <Py_ssize_t>((key * 11400714819323198485ULL) >> shift)
+    while values[slot] >= 0:
+        if keys[slot] == key:
+            return values[slot]
+        slot = (slot + 1) & mask
+    return -1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def lookup_keys(
+    const unsigned long long[::1] query,
+    const unsigned long long[::1] keys,
+    const long long[::1] values,
+    int shift,
+    long long missing,
+):
+    """
+    Looks keys up in an open addressing hash table made by keter.models.tokens,
+    returning missing for absent keys.
+    """
+    found_array = np.empty(query.shape[0], dtype=np.int64)
+    cdef long long[::1] found = found_array
+    cdef long long value
+    cdef Py_ssize_t i
+
+    with nogil:
+        for i in range(query.shape[0]):
+            value = _probe(query[i], keys, values, shift)
+            found[i] = value if value >= 0 else missing
+
+    return found_array
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def select_ngrams(
+    const long long[::1] ids,
+    const long long[::1] indptr,
+    int max_ngram,
+    unsigned long long base,
+    const unsigned long long[::1] keys,
+    const long long[::1] values,
+    int shift,
+):
+    """
+    Finds the vocabulary features among the 1 to max_ngram grams of documents of
+    token ids, in the order CountVectorizer generates grams (all unigrams, then
+    all bigrams and so on). A gram is coded as its ids as digits in base, which
+    packs it exactly while base ** max_ngram fits in 64 bits and wraps into a
+    polynomial hash beyond, and looked up in the vocabulary hash table. Grams
+    with an unknown token (id 0) are skipped. Returns features and indptr.
+    """
+    cdef Py_ssize_t documents = indptr.shape[0] - 1
+    features_array = np.empty(ids.shape[0] * max_ngram, dtype=np.int64)
+    features_indptr_array = np.empty(documents + 1, dtype=np.int64)
+    cdef long long[::1] features = features_array
+    cdef long long[::1] features_indptr = features_indptr_array
+    cdef unsigned long long code
+    cdef long long feature
+    cdef Py_ssize_t d, n, i, k, count = 0
+    cdef bint known
+
+    with nogil:
+        for d in range(documents):
+            features_indptr[d] = count
+            for n in range(1, max_ngram + 1):
+                for i in range(indptr[d], indptr[d + 1] - n + 1):
+                    code = 0
+                    known = True
+                    for k in range(i, i + n):
+                        if ids[k] == 0:
+                            known = False
+                            break
+                        code = code * base + <unsigned long long>ids[k]
+                    if known:
+                        feature = _probe(code, keys, values, shift)
+                        if feature >= 0:
+                            features[count] = feature
+                            count += 1
+        features_indptr[documents] = count
+
+    return features_array[:count], features_indptr_array
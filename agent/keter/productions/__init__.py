@@ -16,18 +16,22 @@ def drug_discovery_on_moses(mode="prod"):
     from tqdm.auto import tqdm
     import pandas as pd
 
-    from keter.stage import FileSystemStage, get_path
+    from keter.stage import FileSystemStage, MemoryStage, get_path
     from keter.actors.sklearn import Analyzer
     from keter.datasets.raw import Moses
     from keter.interfaces.chemistry import create_jamstack
 
-    with FileSystemStage():
+    with MemoryStage(FileSystemStage(codecs={"model": "mmap"})):
         if mode == "prod":
             analyzer = Analyzer()
         elif mode == "doc2vec":
             analyzer = Analyzer("doc2vec")
         elif mode == "lda":
             analyzer = Analyzer("lda")
+        elif mode == "sparse":
+            analyzer = Analyzer("sparse")
+        elif mode == "canonical":
+            analyzer = Analyzer("canonical")
         else:
             raise ValueError(f"Invalid mode: {mode}")
         moses = Moses().to_df()["SMILES"].tolist()
@@ -60,4 +64,27 @@ def drug_discovery_on_moses_doc2vec():
 
 
 def drug_discovery_on_moses_lda():
-    drug_discovery_on_moses("lda")
\ No newline at end of file
+    drug_discovery_on_moses("lda")
+
+
+def drug_discovery_on_moses_sparse():
+    drug_discovery_on_moses("sparse")
+
+
+def drug_discovery_on_moses_canonical():
+    drug_discovery_on_moses("canonical")
+
+
+def update_forecasting_rollup():
+    import logging
+    from keter.stage import FileSystemStage
+    from keter.datasets.constructed import InfectionNet
+    from keter.systems.forecasting import RollupCube
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+    with FileSystemStage():
+        new_dates = InfectionNet().update()
+        logger.info("Added %d report dates to InfectionNet", len(new_dates))
+        new_dates = RollupCube().update()
+        logger.info("Added %d report dates to the forecasting rollup", len(new_dates))
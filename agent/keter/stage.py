@@ -1,21 +1,188 @@
 import os
+import sys
+import operator
+import shutil
+import hashlib
+import inspect
+import json
+import logging
+import mmap
+import struct
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import partial
+from uuid import uuid4
 from enum import Enum
 import pickle
 from pathlib import Path
-from typing import Sequence, Callable, Any
+from typing import Sequence, Callable, Any, List
 import lzma
+import numpy as np
 import pandas as pd
 from dvc.repo import Repo
+from keter.util.transfer import (
+    ChecksumError,
+    open_remote,
+    download,
+    download_tree,
+    upload,
+    upload_tree,
+)
+from keter.util.manifest import manifest_path, write_manifest
 
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking on platforms without fcntl (Windows)
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
 
 _stage = [None]
 
+# Pickled artifacts can be stored as lzma compressed pickles (".pkz") or as
+# protocol 5 pickles with their large buffers stored out-of-band (".pkm"), which
+# are memory mapped when loaded instead of being decompressed.
+ARTIFACT_CODECS = {"lzma": ".pkz", "mmap": ".pkm"}
+_MMAP_MAGIC = b"KETERPKM"
+_MMAP_ALIGN = 64
+
+
+def _dump_mmap(obj: Any, fd):
+    buffers = []
+    payload = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    segments = [memoryview(payload)] + [buffer.raw() for buffer in buffers]
+
+    offset = struct.calcsize("<8sQ") + struct.calcsize("<QQ") * len(segments)
+    table = []
+    for segment in segments:
+        offset += -offset % _MMAP_ALIGN
+        table.append((offset, segment.nbytes))
+        offset += segment.nbytes
+
+    fd.write(struct.pack("<8sQ", _MMAP_MAGIC, len(segments)))
+    for entry in table:
+        fd.write(struct.pack("<QQ", *entry))
+    for (offset, _), segment in zip(table, segments):
+        fd.write(b"\0" * (offset - fd.tell()))
+        fd.write(segment)
+
+
+def _load_mmap(path: Path) -> Any:
+    with open(path, "rb") as fd:
+        # Copy-on-write mapping: pages are read lazily and arrays stay writable
+        view = memoryview(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_COPY))
+    magic, count = struct.unpack_from("<8sQ", view)
+    if magic != _MMAP_MAGIC:
+        raise ValueError(f"Not a memory mappable artifact: {path}")
+    table = [
+        struct.unpack_from("<QQ", view, struct.calcsize("<8sQ") + i * 16)
+        for i in range(count)
+    ]
+    payload, *buffers = [view[offset : offset + length] for offset, length in table]
+    return pickle.loads(payload, buffers=buffers)
+
+
+_FILTER_OPS = {
+    "=": operator.eq,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda series, values: series.isin(values),
+    "not in": lambda series, values: ~series.isin(values),
+}
+
+
+def _select(
+    dataframe: pd.DataFrame, columns: Sequence[str] = None, filters: List = None
+) -> pd.DataFrame:
+    """
+    Applies a column projection and row filters in the same disjunctive normal
+    form as the Parquet reader to a DataFrame that is already in memory.
+    """
+    if filters:
+        disjunction = filters if isinstance(filters[0], list) else [filters]
+        mask = np.zeros(len(dataframe), dtype=bool)
+        for conjunction in disjunction:
+            part = np.ones(len(dataframe), dtype=bool)
+            for column, op, value in conjunction:
+                part &= _FILTER_OPS[op](dataframe[column], value).to_numpy()
+            mask |= part
+        dataframe = dataframe[mask].reset_index(drop=True)
+    if columns is not None:
+        dataframe = dataframe[list(columns)]
+    return dataframe
+
+
+def _lock_path(path: Path) -> Path:
+    """
+    Lock files live in one hidden directory at the cache root, mirroring the
+    artifact layout, rather than as sidecars next to the artifacts.
+    """
+    root = get_path("root")
+    try:
+        relative = path.relative_to(root)
+    except ValueError:
+        return path.with_name(f".{path.name}.lock")
+    return root / ".locks" / relative.with_name(relative.name + ".lock")
+
+
+@contextmanager
+def _locked(path: Path):
+    """
+    Holds an exclusive lock on the lock file of path, shared by every process and
+    thread working on the same cache volume.
+    """
+    lock_path = _lock_path(path)
+    lock_path.parents[0].mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a") as fd:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+@contextmanager
+def _atomic_path(path: Path):
+    """
+    Yields a temporary path next to path that is renamed onto it on success, so
+    readers never see a partially written artifact. Nothing happens if the
+    temporary path was never written.
+    """
+    tmp_path = path.with_name(f".{uuid4().hex}.{path.name}")
+    try:
+        yield tmp_path
+        if tmp_path.exists():
+            os.replace(tmp_path, path)
+    finally:
+        if tmp_path.is_dir():
+            shutil.rmtree(tmp_path)
+        elif tmp_path.exists():
+            tmp_path.unlink()
+
 
 class Stage:
-    def __init__(self):
+    def __init__(self, content_addressed: bool = None, codecs: dict = None):
         global _stage
         self._old_stage = _stage[0]
         _stage[0] = self
+        if content_addressed is None:
+            content_addressed = bool(os.environ.get("KETER_CONTENT_ADDRESSED"))
+        self.content_addressed = content_addressed
+        self.codecs = codecs or {}
+        for codec in self.codecs.values():
+            if codec not in ARTIFACT_CODECS:
+                raise ValueError(f"Invalid artifact codec: {codec}")
 
     def __enter__(self):
         pass
@@ -24,12 +191,70 @@ class Stage:
         global _stage
         _stage[0] = self._old_stage
 
+    def resolve(self, product: str, name: str, key: str = None) -> Path:
+        """
+        Maps an artifact name to its path, applying the artifact codec chosen for
+        the product and inserting the content key if this stage is content
+        addressed.
+        """
+        path = get_path(product) / name
+        if path.suffix in ARTIFACT_CODECS.values() and product in self.codecs:
+            path = path.with_suffix(ARTIFACT_CODECS[self.codecs[product]])
+        if self.content_addressed and key:
+            stem, dot, suffix = path.name.partition(".")
+            path = path.with_name(f"{stem}-{key}{dot}{suffix}")
+        return path
+
+    def scan(
+        self,
+        path: Path,
+        func: Callable,
+        columns: Sequence[str] = None,
+        filters: List = None,
+        mode="b",
+        writer: Callable = None,
+    ) -> pd.DataFrame:
+        """
+        Reads a cached DataFrame, pushing the column projection and row filters
+        down into the Parquet reader when the artifact is already on disk.
+        """
+        if path.suffix == ".parquet" and path.exists():
+            return pd.read_parquet(path, columns=columns, filters=filters)
+        return _select(self.cache(path, func, mode, writer), columns, filters)
+
+    def locate(self, path: Path, func: Callable, mode="b", writer=None) -> Path:
+        """
+        Returns the path of a persisted artifact, or None if this stage does not
+        persist it, for readers that work on the files directly.
+        """
+        return path if path.exists() else None
+
+    def update(
+        self, path: Path, func: Callable, updater: Callable, mode="b", writer=None
+    ) -> Any:
+        """
+        Changes a persisted artifact in place with updater, which is called with
+        its path while no other worker builds or updates it, and returns what
+        updater returns. Missing artifacts are built first. Stages that do not
+        persist artifacts have nothing to update and return None.
+        """
+        return None
+
+    def refresh(self, path: Path, func: Callable, mode="b", writer=None) -> Any:
+        """
+        Rebuilds an artifact even if the stage already has it, for sources that
+        change upstream. Stages that do not persist artifacts just call func.
+        """
+        return func()
+
     def _read_cache(self, path: Path):
         if path.suffix == ".parquet":
             return pd.read_parquet(path)
         elif path.suffix == ".pkz":
             with lzma.open(path, "rb") as fd:
                 return pickle.load(fd)
+        elif path.suffix == ".pkm":
+            return _load_mmap(path)
         elif path.suffix == ".txt.xz":
             with lzma.open(path, "rt") as fd:
                 return fd.readlines()
@@ -37,14 +262,33 @@ class Stage:
             with open(path, "rb") as fd:
                 return fd.read()
 
+    def _write_cache(self, path: Path, obj: Any, mode="b"):
+        if isinstance(obj, pd.DataFrame):
+            obj.to_parquet(path)
+        elif isinstance(obj, bytes):
+            with open(path, "w" + mode) as fd:
+                fd.write(obj)
+        elif path.suffix == ".pkm":
+            with open(path, "wb") as fd:
+                _dump_mmap(obj, fd)
+        else:
+            with lzma.open(path, "w" + mode) as fd:
+                pickle.dump(obj, fd)
+
 
 class NullStage(Stage):
-    def cache(self, path: Path, func: Callable, mode=None):
+    def cache(self, path: Path, func: Callable, mode=None, writer=None):
         return func()
 
+    def scan(self, path, func, columns=None, filters=None, mode=None, writer=None):
+        return _select(func(), columns, filters)
+
+    def locate(self, path, func, mode=None, writer=None):
+        return None
+
 
 class ReadOnlyStage(Stage):
-    def cache(self, path: Path, func: Callable, mode=None):
+    def cache(self, path: Path, func: Callable, mode=None, writer=None):
         if path.exists():
             return self._read_cache(path)
         else:
@@ -52,42 +296,389 @@ class ReadOnlyStage(Stage):
 
 
 class FileSystemStage(Stage):
-    def cache(self, path: Path, func: Callable, mode="b") -> Any:
-        if path.exists():
-            return self._read_cache(path)
+    def _build(self, path: Path, func: Callable, mode="b", writer=None) -> tuple:
+        """
+        Builds a missing artifact. Returns whether this worker built it, and the
+        object if it was built in memory rather than streamed to disk by writer.
+        """
+        path.parents[0].mkdir(parents=True, exist_ok=True)
+        # Only one worker builds an artifact, the others wait and read its result
+        with _locked(path):
+            if path.exists():
+                return False, None
+            if path.suffix in ARTIFACT_CODECS.values():
+                # Transcode artifacts written with another codec instead of rebuilding
+                for suffix in ARTIFACT_CODECS.values():
+                    if path.with_suffix(suffix).exists():
+                        func = partial(self._read_cache, path.with_suffix(suffix))
+                        writer = None
+            with _atomic_path(path) as tmp_path:
+                if writer:
+                    writer(tmp_path)
+                    obj = None
+                else:
+                    obj = func()
+                    self._write_cache(tmp_path, obj, mode)
+            self._describe(path)
+            return True, obj
+
+    @staticmethod
+    def _describe(path: Path):
+        # Datasets get a manifest, so they can be sized and listed without reading
+        if path.suffix == ".parquet" and path.exists():
+            write_manifest(path)
+
+    def cache(self, path: Path, func: Callable, mode="b", writer=None) -> Any:
+        if not path.exists():
+            built, obj = self._build(path, func, mode, writer)
+            if built and not writer:
+                return obj
+        return self._read_cache(path)
+
+    def scan(self, path, func, columns=None, filters=None, mode="b", writer=None):
+        if not path.exists():
+            built, obj = self._build(path, func, mode, writer)
+            if built and not writer:
+                return _select(obj, columns, filters)
+        return super().scan(path, func, columns, filters, mode)
+
+    def locate(self, path, func, mode="b", writer=None):
+        if not path.exists():
+            self._build(path, func, mode, writer)
+        return path
+
+    def update(self, path, func, updater, mode="b", writer=None):
+        self.locate(path, func, mode, writer)
+        with _locked(path):
+            result = updater(path)
+            self._describe(path)
+        return result
+
+    def refresh(self, path: Path, func: Callable, mode="b", writer=None) -> Any:
+        path.parents[0].mkdir(parents=True, exist_ok=True)
+        # The new artifact replaces the old one in one rename, readers see either
+        with _locked(path):
+            with _atomic_path(path) as tmp_path:
+                if writer:
+                    writer(tmp_path)
+                else:
+                    obj = func()
+                    self._write_cache(tmp_path, obj, mode)
+            self._describe(path)
+        return self._read_cache(path) if writer else obj
+
+
+class MemoryStage(Stage):
+    """
+    Process-local LRU memory tier stacked on another stage. DataFrames, arrays and
+    bytes are kept in memory up to a byte budget, so repeated reads of the same
+    artifact only touch the wrapped stage once. Callers get copies and are free to
+    mutate them. Other objects (such as models) pass straight through.
+    """
+
+    def __init__(self, stage: Stage, max_bytes: int = 4 * 2 ** 30):
+        super().__init__(stage.content_addressed, stage.codecs)
+        # The wrapped stage made itself current when constructed, take its place
+        self._old_stage = stage._old_stage
+        self.stage = stage
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __exit__(self, *kwargs):
+        logger.info(
+            "Memory stage: %(hits)d hits, %(misses)d misses, "
+            "%(entries)d entries, %(bytes)d bytes",
+            self.stats(),
+        )
+        self.stage.__exit__(*kwargs)
+        super().__exit__(*kwargs)
+
+    def resolve(self, product: str, name: str, key: str = None) -> Path:
+        return self.stage.resolve(product, name, key)
+
+    @staticmethod
+    def _sizeof(obj: Any) -> int:
+        if isinstance(obj, pd.DataFrame):
+            return int(obj.memory_usage(index=True, deep=True).sum())
+        elif isinstance(obj, np.ndarray):
+            return obj.nbytes
+        elif isinstance(obj, bytes):
+            return sys.getsizeof(obj)
+        else:
+            return None
+
+    @staticmethod
+    def _copy(obj: Any) -> Any:
+        if isinstance(obj, (pd.DataFrame, np.ndarray)):
+            return obj.copy()
         else:
-            obj = func()
-            path.parents[0].mkdir(parents=True, exist_ok=True)
-            if isinstance(obj, pd.DataFrame):
-                obj.to_parquet(path)
-            elif isinstance(obj, bytes):
-                with open(path, "w" + mode) as fd:
-                    fd.write(obj)
-            else:
-                with lzma.open(path, "w" + mode) as fd:
-                    pickle.dump(obj, fd)
             return obj
 
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+        }
+
+    def _store(self, key: Any, obj: Any):
+        size = self._sizeof(obj)
+        if size is None or size > self.max_bytes:
+            return
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (obj, size)
+                self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_size
+
+    def scan(self, path, func, columns=None, filters=None, mode="b", writer=None):
+        # Partial reads are kept apart from the whole artifact, by their selection
+        key = (path, None if columns is None else tuple(columns), repr(filters))
+        with self._lock:
+            for entry in (path, key):
+                if entry in self._entries:
+                    self._entries.move_to_end(entry)
+                    self.hits += 1
+                    obj = self._entries[entry][0]
+                    if entry == path:
+                        return _select(obj, columns, filters).copy()
+                    return obj.copy()
+            self.misses += 1
+
+        obj = self.stage.scan(path, func, columns, filters, mode, writer)
+        self._store(key, obj)
+        return self._copy(obj)
+
+    def locate(self, path, func, mode="b", writer=None):
+        return self.stage.locate(path, func, mode, writer)
+
+    def _evict(self, path: Path):
+        with self._lock:
+            for key in list(self._entries):
+                if key == path or (isinstance(key, tuple) and key[0] == path):
+                    _, size = self._entries.pop(key)
+                    self.nbytes -= size
+
+    def update(self, path, func, updater, mode="b", writer=None):
+        self._evict(path)
+        return self.stage.update(path, func, updater, mode, writer)
+
+    def refresh(self, path: Path, func: Callable, mode="b", writer=None) -> Any:
+        self._evict(path)
+        return self.stage.refresh(path, func, mode, writer)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def cache(self, path: Path, func: Callable, mode="b", writer=None) -> Any:
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return self._copy(self._entries[path][0])
+            self.misses += 1
+
+        obj = self.stage.cache(path, func, mode, writer)
+        self._store(path, obj)
+        return self._copy(obj)
+
+
+class RemoteStage(FileSystemStage):
+    """
+    File system stage backed by a remote artifact store (a directory or an HTTP/S3
+    compatible server, defaulting to KETER_REMOTE). Missing artifacts are pulled
+    on demand and new ones are pushed in the background, both in parallel chunks
+    with checksums. Pending pushes finish when the stage block exits.
+    """
+
+    def __init__(
+        self, remote: str = None, workers: int = 8, push: bool = True, **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.remote = open_remote(remote or os.environ["KETER_REMOTE"])
+        self.workers = workers
+        self.push = push
+        self._pushes = ThreadPoolExecutor(max_workers=2)
+        self._pending = []
+
+    def __exit__(self, *kwargs):
+        try:
+            done, _ = wait(self._pending)
+            for future in done:
+                future.result()
+        finally:
+            self._pushes.shutdown()
+            super().__exit__(*kwargs)
+
+    def _remote_name(self, path: Path) -> str:
+        return path.relative_to(get_path("root")).as_posix()
+
+    def pull(self, path: Path) -> bool:
+        path.parents[0].mkdir(parents=True, exist_ok=True)
+        with _locked(path):
+            if path.exists():
+                return True
+            name = self._remote_name(path)
+            # A push of the same artifact replaces it while it is read, which shows
+            # as a checksum mismatch. It is pulled again once, then built locally.
+            for attempt in range(2):
+                try:
+                    with _atomic_path(path) as tmp_path:
+                        # Directory artifacts, such as partitioned datasets, go
+                        # file by file
+                        if not download(self.remote, name, tmp_path, self.workers):
+                            download_tree(self.remote, name, tmp_path, self.workers)
+                    break
+                except ChecksumError as err:
+                    if attempt:
+                        warnings.warn(f"Building {name} locally: {err}")
+                        return False
+            if not path.exists():
+                return False
+            try:
+                with _atomic_path(manifest_path(path)) as tmp_path:
+                    pulled = download(self.remote, name + ".json", tmp_path)
+            except ChecksumError:
+                pulled = False
+            if not pulled:
+                self._describe(path)
+            return True
+
+    def _upload(self, path: Path):
+        name = self._remote_name(path)
+        if path.is_dir():
+            upload_tree(self.remote, name, path, self.workers)
+        else:
+            upload(self.remote, name, path, self.workers)
+        if manifest_path(path).is_file():
+            upload(self.remote, name + ".json", manifest_path(path), self.workers)
+
+    def _push(self, path: Path):
+        if self.push and path.exists():
+            self._pending.append(self._pushes.submit(self._upload, path))
+
+    def _build(self, path: Path, func: Callable, mode="b", writer=None) -> tuple:
+        if self.pull(path):
+            return False, None
+        built, obj = super()._build(path, func, mode, writer)
+        if built:
+            self._push(path)
+        return built, obj
+
+    def update(self, path, func, updater, mode="b", writer=None):
+        result = super().update(path, func, updater, mode, writer)
+        self._push(path)
+        return result
+
+    def refresh(self, path: Path, func: Callable, mode="b", writer=None) -> Any:
+        obj = super().refresh(path, func, mode, writer)
+        self._push(path)
+        return obj
+
 
 class DvcStage(FileSystemStage):
-    files = []
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.files = []
+
+    def cache(self, path: Path, func: Callable, mode="b", writer=None) -> Any:
+        self.files.append(path)
+        return super().cache(path, func, mode, writer)
 
-    def cache(self, path: Path, func: Callable, mode="b") -> Any:
+    def update(self, path, func, updater, mode="b", writer=None):
         self.files.append(path)
-        return super().cache(path, func, mode)
+        return super().update(path, func, updater, mode, writer)
+
+    def refresh(self, path: Path, func: Callable, mode="b", writer=None) -> Any:
+        self.files.append(path)
+        return super().refresh(path, func, mode, writer)
 
     def __exit__(self, *kwargs):
         super().__exit__(*kwargs)
 
         repo = Repo(get_path("root"))
 
+        files = [str(file) for file in self.files]
         repo.add(files)
         for file in files:
             repo.commit(file)
         repo.push(files)
 
 
-def cache(product: str, name: str, func: Callable) -> Any:
+def cache(
+    product: str, name: str, func: Callable, key: str = None, writer: Callable = None
+) -> Any:
+    """
+    Returns the artifact name of product, calling func to build it if the stage
+    does not have it. A writer, if given, streams the artifact to the path it is
+    called with instead, for artifacts too large to build in memory.
+    """
+    stage = _stage[0]
+    if not stage:
+        raise ValueError(
+            "There is no stage defined. Make sure you only call "
+            "actors and datasets inside of a stage block."
+        )
+    else:
+        return stage.cache(stage.resolve(product, name, key), func, writer=writer)
+
+
+def scan(
+    product: str,
+    name: str,
+    func: Callable,
+    columns: Sequence[str] = None,
+    filters: List = None,
+    key: str = None,
+    writer: Callable = None,
+) -> pd.DataFrame:
+    stage = _stage[0]
+    if not stage:
+        raise ValueError(
+            "There is no stage defined. Make sure you only call "
+            "actors and datasets inside of a stage block."
+        )
+    else:
+        return stage.scan(
+            stage.resolve(product, name, key), func, columns, filters, writer=writer
+        )
+
+
+def locate(
+    product: str, name: str, func: Callable, key: str = None, writer: Callable = None
+) -> Path:
+    stage = _stage[0]
+    if not stage:
+        raise ValueError(
+            "There is no stage defined. Make sure you only call "
+            "actors and datasets inside of a stage block."
+        )
+    else:
+        return stage.locate(stage.resolve(product, name, key), func, writer=writer)
+
+
+def update(
+    product: str,
+    name: str,
+    func: Callable,
+    updater: Callable,
+    key: str = None,
+    writer: Callable = None,
+) -> Any:
+    """
+    Changes the artifact name of product in place by calling updater with its
+    path under the artifact lock, building it first if the stage does not have
+    it. Returns what updater returns, or None if the stage does not persist it.
+    """
     stage = _stage[0]
     if not stage:
         raise ValueError(
@@ -95,11 +686,157 @@ def cache(product: str, name: str, func: Callable) -> Any:
             "actors and datasets inside of a stage block."
         )
     else:
-        return stage.cache(get_path(product) / name, func)
+        return stage.update(
+            stage.resolve(product, name, key), func, updater, writer=writer
+        )
+
+
+def refresh(
+    product: str, name: str, func: Callable, key: str = None, writer: Callable = None
+) -> Any:
+    """
+    Rebuilds the artifact name of product with func and returns it, replacing
+    whatever the stage had.
+    """
+    stage = _stage[0]
+    if not stage:
+        raise ValueError(
+            "There is no stage defined. Make sure you only call "
+            "actors and datasets inside of a stage block."
+        )
+    else:
+        return stage.refresh(stage.resolve(product, name, key), func, writer=writer)
+
+
+# Code fingerprints of callables and classes, their sources do not change at runtime
+_code_fingerprints = {}
+
+
+def _source(obj: Any) -> bytes:
+    try:
+        return inspect.getsource(obj).encode()
+    except (OSError, TypeError):
+        pass
+    # Compiled functions (keter.operations) are versioned by their Cython source,
+    # or by the extension module itself when it is installed without it
+    module = sys.modules.get(getattr(obj, "__module__", None) or "")
+    module_file = Path(getattr(module, "__file__", None) or "")
+    # Builtins and functions defined in python -c have no module file
+    if module is not None and module_file.name:
+        pyx = module_file.with_name(module.__name__.rpartition(".")[2] + ".pyx")
+        if pyx.is_file():
+            return pyx.read_bytes()
+        elif module_file.is_file():
+            return module_file.read_bytes()
+    return getattr(obj, "__qualname__", type(obj).__qualname__).encode()
+
+
+def _code_objects(obj: Any) -> list:
+    if inspect.isclass(obj):
+        functions = []
+        for attr in vars(obj).values():
+            attr = getattr(attr, "__func__", attr)
+            if isinstance(attr, property):
+                attr = attr.fget
+            if inspect.isfunction(attr):
+                functions.append(attr)
+    else:
+        functions = [obj] if inspect.isfunction(obj) else []
+    codes = [function.__code__ for function in functions]
+    for code in codes:
+        codes.extend(const for const in code.co_consts if inspect.iscode(const))
+    return codes
+
+
+def _referenced(obj: Any) -> list:
+    """
+    The keter functions and classes obj refers to by name, either as globals of
+    its module or as attributes of the class it is defined in.
+    """
+    module = sys.modules.get(getattr(obj, "__module__", None) or "")
+    namespace = vars(module) if module else {}
+    owner = None
+    if not inspect.isclass(obj):
+        qualname = getattr(obj, "__qualname__", "").split(".")[:-1]
+        owner = namespace.get(qualname[0]) if qualname else None
+    referenced = []
+    for code in _code_objects(obj):
+        for name in code.co_names:
+            target = namespace.get(name, getattr(owner, name, None))
+            target = getattr(target, "__func__", target)
+            if (
+                (inspect.isclass(target) or inspect.isroutine(target))
+                and (getattr(target, "__module__", None) or "").startswith("keter")
+                and target is not obj
+            ):
+                referenced.append(target)
+    return referenced
+
+
+def _code_fingerprint(obj: Any) -> bytes:
+    """
+    Hashes the source of a callable or class together with the sources of the
+    keter code it references, followed transitively, so editing a helper changes
+    the keys of everything built with it.
+    """
+    # Functions are remembered by their code, lambdas are created per call
+    memo = getattr(obj, "__code__", obj)
+    if memo not in _code_fingerprints:
+        sources = {}
+        pending = [obj]
+        while pending:
+            current = pending.pop()
+            module = getattr(current, "__module__", None)
+            name = f"{module}.{getattr(current, '__qualname__', None)}"
+            if name not in sources:
+                sources[name] = _source(current)
+                pending.extend(_referenced(current))
+        digest = hashlib.sha256()
+        for name in sorted(sources):
+            digest.update(_fingerprint_part([name.encode(), sources[name]]))
+        qualname = getattr(obj, "__qualname__", type(obj).__qualname__)
+        _code_fingerprints[memo] = qualname.encode() + digest.hexdigest().encode()
+    return _code_fingerprints[memo]
+
+
+def _fingerprint_part(part: Any) -> bytes:
+    if isinstance(part, bytes):
+        return part
+    elif isinstance(part, (str, int, float, bool)) or part is None:
+        return repr(part).encode()
+    elif isinstance(part, dict):
+        return json.dumps(part, sort_keys=True, default=repr).encode()
+    elif isinstance(part, (list, tuple)):
+        # Length prefixed, so ["ab", "c"] and ["a", "bc"] differ
+        encoded = [_fingerprint_part(i) for i in part]
+        return b"".join(b"%d:%s" % (len(i), i) for i in encoded)
+    elif inspect.isclass(part) or callable(part):
+        return _code_fingerprint(getattr(part, "__func__", part))
+    else:
+        return _fingerprint_part(
+            {
+                attr: getattr(part, attr)
+                for attr in dir(part)
+                if not attr.startswith("_") and not callable(getattr(part, attr))
+            }
+        )
+
+
+def fingerprint(*parts: Any) -> str:
+    """
+    Creates a stable content key out of the code of producing callables, their
+    hyperparameters and the keys of upstream artifacts. Used for content
+    addressed stages, so only artifacts whose inputs changed are rebuilt.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(_fingerprint_part(part))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
 
 
 def get_path(product: str) -> Path:
-    CACHE_ROOT = (
+    CACHE_ROOT = Path(
         os.environ.get("KETER_CACHE")
         or (Path(__file__).parent.parent.parent / "cache").absolute()
     )
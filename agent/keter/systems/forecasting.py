@@ -0,0 +1,344 @@
+import os
+import json
+from pathlib import Path
+from typing import Sequence
+import numpy as np
+import pandas as pd
+from keter.stage import fingerprint, locate, update
+from keter.datasets.raw import CoronaDeathsUSA
+from keter.datasets.constructed import InfectionNet, generate_infections
+
+DAY = 86400
+# Cases are simulated up to 15 days before the death that reveals them
+CASE_LEAD_DAYS = 15
+
+
+class RollupCube:
+    """
+    Precomputed county by day rollup of reported deaths and simulated infections,
+    with state and national levels, stored as day-major memory-mapped arrays.
+    New days are appended to the end of every array, so refreshing the cube only
+    processes the dates it has not seen. Model features are slices of the arrays.
+    The cube is a stage artifact, built from the current reports when first used.
+    """
+
+    filename = "rollup"
+    measures = ("deaths", "infections")
+    levels = ("county", "state", "nation")
+
+    def __init__(self):
+        path = locate(
+            "constructed", self.filename, None, key=self.key(), writer=self._build
+        )
+        if path is None:
+            raise ValueError("The rollup cube needs a stage that persists artifacts")
+        self._open(path)
+
+    @classmethod
+    def _at(cls, path: Path) -> "RollupCube":
+        # A cube in a given directory, such as the one a stage builds or updates
+        cube = cls.__new__(cls)
+        cube._open(path)
+        return cube
+
+    def _open(self, path: Path):
+        self.path = Path(path)
+        meta_file = self.path / "meta.json"
+        self.meta = json.loads(meta_file.read_text()) if meta_file.exists() else None
+
+    def key(self) -> str:
+        return fingerprint(RollupCube, InfectionNet().key())
+
+    @property
+    def start(self) -> int:
+        return self.meta["start"]
+
+    @property
+    def days(self) -> int:
+        return self.meta["days"]
+
+    @property
+    def dates(self) -> np.ndarray:
+        return self.start + DAY * np.arange(self.days, dtype=np.int64)
+
+    def day_index(self, timestamp: int) -> int:
+        return (int(timestamp) - self.start) // DAY
+
+    def _units(self, level: str) -> int:
+        if level == "county":
+            return len(self.meta["uids"])
+        elif level == "state":
+            return len(self.meta["states"])
+        elif level == "nation":
+            return 1
+        else:
+            raise ValueError(f"Invalid level: {level}")
+
+    def names(self, level: str = "county") -> list:
+        if level == "county":
+            return self.meta["uids"]
+        elif level == "state":
+            return self.meta["states"]
+        else:
+            return ["US"]
+
+    def population(self, level: str = "county") -> np.ndarray:
+        population = np.asarray(self.meta["population"], dtype=np.float64)
+        if level == "county":
+            return population
+        elif level == "state":
+            return np.bincount(
+                self.meta["county_state"],
+                weights=population,
+                minlength=len(self.meta["states"]),
+            )
+        else:
+            return population.sum(keepdims=True)
+
+    def series(self, measure: str, level: str = "county") -> np.ndarray:
+        """
+        Returns the days by units array of a measure, memory mapped read-only.
+        """
+        if measure not in self.measures:
+            raise ValueError(f"Invalid measure: {measure}")
+        return np.memmap(
+            self.path / f"{measure}_{level}.f32",
+            dtype=np.float32,
+            mode="r",
+            shape=(self.days, self._units(level)),
+        )
+
+    def rolling_sum(
+        self, measure: str, window: int, level: str = "county"
+    ) -> np.ndarray:
+        """
+        Sums over the trailing window of days ending on each day, computed from a
+        running total instead of per-window passes.
+        """
+        totals = np.cumsum(self.series(measure, level), axis=0, dtype=np.float64)
+        result = totals.copy()
+        result[window:] -= totals[:-window]
+        return result
+
+    def rate(
+        self, measure: str, window: int, level: str = "county", per: int = 100000
+    ) -> np.ndarray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (
+                self.rolling_sum(measure, window, level) / self.population(level) * per
+            )
+
+    def features(
+        self,
+        measure: str,
+        end: int,
+        days: int,
+        window: int = 1,
+        level: str = "county",
+    ) -> np.ndarray:
+        """
+        Returns the units by days matrix of trailing window sums for the given
+        number of days up to and including the end timestamp.
+        """
+        stop = self.day_index(end) + 1
+        if stop - days < 0 or stop > self.days:
+            raise ValueError(
+                f"The cube covers {self.days} days from {self.start}, "
+                f"not {days} days up to {end}"
+            )
+        if window == 1:
+            return np.asarray(self.series(measure, level)[stop - days : stop]).T
+        return self.rolling_sum(measure, window, level)[stop - days : stop].T
+
+    def _create(self, corona_deaths: pd.DataFrame, first_date: int):
+        self.path.mkdir(parents=True, exist_ok=True)
+        states = sorted(corona_deaths["Province_State"].astype(str).unique())
+        self.meta = {
+            "start": int(first_date) - CASE_LEAD_DAYS * DAY,
+            "days": 0,
+            "last_report": None,
+            "uids": corona_deaths["UID"].astype(np.int64).tolist(),
+            "states": states,
+            "county_state": pd.Index(states)
+            .get_indexer(corona_deaths["Province_State"].astype(str))
+            .tolist(),
+            "population": (
+                corona_deaths["Population"].fillna(0).tolist()
+                if "Population" in corona_deaths
+                else [0.0] * len(corona_deaths)
+            ),
+        }
+        for measure in self.measures:
+            for level in self.levels:
+                (self.path / f"{measure}_{level}.f32").touch()
+
+    def _extend(self, days: int):
+        # Rows are days, so growing the cube is appending zeroed rows to each file
+        for measure in self.measures:
+            for level in self.levels:
+                with open(self.path / f"{measure}_{level}.f32", "ab") as fd:
+                    fd.write(bytes(4 * (days - self.days) * self._units(level)))
+        self.meta["days"] = days
+
+    def _add(self, measure: str, first_day: int, block: np.ndarray):
+        """
+        Adds a days by counties block to the county rows starting at first_day and
+        to the state and national rollups derived from it.
+        """
+        rows = slice(first_day, first_day + len(block))
+        membership = np.zeros((block.shape[1], len(self.meta["states"])), np.float32)
+        membership[np.arange(block.shape[1]), self.meta["county_state"]] = 1
+        for level, values in (
+            ("county", block),
+            ("state", block @ membership),
+            ("nation", block.sum(axis=1, keepdims=True)),
+        ):
+            array = np.memmap(
+                self.path / f"{measure}_{level}.f32",
+                dtype=np.float32,
+                mode="r+",
+                shape=(self.days, self._units(level)),
+            )
+            array[rows] += values
+            array.flush()
+
+    def _save_meta(self):
+        tmp_file = self.path / ".meta.json.tmp"
+        tmp_file.write_text(json.dumps(self.meta))
+        os.replace(tmp_file, self.path / "meta.json")
+
+    def _journal(self, first_day: int):
+        """
+        Saves the rows an update is about to add to, and the extent of the cube
+        before it, so an interrupted update is rolled back instead of counted twice.
+        """
+        rows = {}
+        for measure in self.measures:
+            for level in self.levels:
+                if first_day < self.days:
+                    rows[f"{measure}_{level}"] = self.series(measure, level)[first_day:]
+                else:
+                    rows[f"{measure}_{level}"] = np.zeros((0, self._units(level)))
+        last_report = self.meta["last_report"]
+        tmp_file = self.path / ".undo.npz.tmp"
+        with open(tmp_file, "wb") as fd:
+            np.savez(
+                fd,
+                first_day=first_day,
+                days=self.days,
+                last_report=-1 if last_report is None else last_report,
+                **rows,
+            )
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp_file, self.path / "undo.npz")
+
+    def _recover(self):
+        """
+        Rolls back an update that was interrupted before it saved its metadata.
+        """
+        undo_file = self.path / "undo.npz"
+        if not undo_file.exists():
+            return
+        with np.load(undo_file) as undo:
+            last_report = self.meta["last_report"]
+            # The metadata is saved last, an update that got that far is complete
+            if (-1 if last_report is None else last_report) == undo["last_report"]:
+                days, first_day = int(undo["days"]), int(undo["first_day"])
+                for measure in self.measures:
+                    for level in self.levels:
+                        array_file = self.path / f"{measure}_{level}.f32"
+                        os.truncate(array_file, 4 * days * self._units(level))
+                        rows = undo[f"{measure}_{level}"]
+                        if len(rows):
+                            array = np.memmap(
+                                array_file,
+                                dtype=np.float32,
+                                mode="r+",
+                                shape=(days, self._units(level)),
+                            )
+                            array[first_day : first_day + len(rows)] = rows
+                            array.flush()
+        undo_file.unlink()
+
+    def _build(self, path: Path):
+        RollupCube._at(path)._apply(CoronaDeathsUSA().to_df())
+
+    def update(self, corona_deaths: pd.DataFrame = None) -> Sequence[int]:
+        """
+        Adds the report dates of a (refreshed) CoronaDeathsUSA frame that the cube
+        has not seen yet and returns them. The stage holds the artifact lock while
+        the cube changes, so concurrent updates do not add the same dates twice.
+        """
+        if corona_deaths is None:
+            corona_deaths = CoronaDeathsUSA().to_df()
+
+        def apply(path: Path) -> Sequence[int]:
+            cube = RollupCube._at(path)
+            new_dates = cube._apply(corona_deaths)
+            self._open(path)
+            return new_dates
+
+        return update(
+            "constructed",
+            self.filename,
+            None,
+            apply,
+            key=self.key(),
+            writer=self._build,
+        )
+
+    def _apply(self, corona_deaths: pd.DataFrame) -> Sequence[int]:
+        infectionnet = InfectionNet()
+        uids, lats, longs, dates, deaths = infectionnet.daily_deaths(corona_deaths)
+
+        if self.meta is None:
+            self._create(corona_deaths, dates[0])
+        self._recover()
+        last_report = self.meta["last_report"]
+        if last_report is None:
+            new = np.ones_like(dates, dtype=bool)
+        else:
+            new = dates > last_report
+        if not new.any():
+            return []
+
+        # Align counties of the refreshed frame with the cube, ignoring new ones
+        positions = pd.Index(self.meta["uids"]).get_indexer(uids)
+        known = positions >= 0
+        counties = len(self.meta["uids"])
+
+        new_dates = dates[new]
+        first_day = self.day_index(new_dates[0]) - CASE_LEAD_DAYS
+        last_day = self.day_index(new_dates[-1])
+
+        death_block = np.zeros((last_day + 1 - first_day, counties), np.float32)
+        infection_block = np.zeros_like(death_block)
+        for date, daily in zip(new_dates, deaths[:, new].T):
+            row = self.day_index(date) - first_day
+            death_block[row, positions[known]] = daily[known]
+            records = generate_infections(
+                int(date),
+                daily[known],
+                uids[known],
+                lats[known],
+                longs[known],
+                infectionnet.seed,
+                infectionnet.infections_per_death,
+            )
+            case_days = (records["timestamp"].to_numpy() - self.start) // DAY
+            case_counties = pd.Index(self.meta["uids"]).get_indexer(records["uid"])
+            case_days -= first_day
+            np.add.at(infection_block, (case_days, case_counties), 1)
+
+        # Downward corrections count as no new deaths, as in the simulation
+        np.clip(np.nan_to_num(death_block), 0, None, out=death_block)
+        self._journal(first_day)
+        self._extend(max(self.days, last_day + 1))
+        self._add("deaths", first_day, death_block)
+        self._add("infections", first_day, infection_block)
+
+        self.meta["last_report"] = int(new_dates[-1])
+        self._save_meta()
+        (self.path / "undo.npz").unlink()
+        return new_dates.tolist()
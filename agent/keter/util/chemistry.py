@@ -1,4 +1,5 @@
-from typing import Sequence
+from typing import Sequence, Optional, Tuple, List
+from concurrent.futures import ProcessPoolExecutor
 from rdkit import Chem
 
 
@@ -10,3 +11,21 @@ def smiles2keys(smiles: Sequence) -> Sequence:
     mols = Chem.SmilesMolSupplierFromText("\n".join(smiles), " ", 0, -1, 0)
     for mol in mols:
         yield Chem.MolToInchiKey(mol)
+
+
+def canonicalize(smiles: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Returns the canonical SMILES and InChIKey of a molecule, or Nones if RDKit
+    cannot parse it.
+    """
+    mol = Chem.MolFromSmiles(smiles) if smiles else None
+    if mol is None:
+        return None, None
+    return Chem.MolToSmiles(mol), Chem.MolToInchiKey(mol)
+
+
+def canonicalize_many(
+    smiles: Sequence[str], workers: int = None, chunksize: int = 2048
+) -> List[Tuple[Optional[str], Optional[str]]]:
+    with ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(canonicalize, smiles, chunksize=chunksize))
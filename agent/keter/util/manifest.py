@@ -0,0 +1,195 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import List
+import pyarrow.parquet as pq
+from keter.util.transfer import sha256sum
+
+# Longest string kept for minimum and maximum column statistics
+MAX_STAT_LENGTH = 64
+
+
+def manifest_path(path: Path) -> Path:
+    return path.with_name(path.name + ".json")
+
+
+def _data_files(path: Path) -> List[Path]:
+    """
+    The Parquet files of an artifact, which is either one file or a directory of
+    partitions. Hidden and underscore files, such as indices, are not data.
+    """
+    if path.is_dir():
+        return sorted(
+            file
+            for file in path.rglob("*.parquet")
+            if not file.relative_to(path).as_posix().startswith(("_", "."))
+        )
+    return [path]
+
+
+def _file_checksums(path: Path, previous: dict = None) -> dict:
+    """
+    The sha256 of every file of an artifact by name, with the file status it was
+    taken at. Checksums from previous whose files have not changed since are
+    reused, so describing a grown artifact only reads its new files.
+    """
+    if path.is_dir():
+        files = [
+            file
+            for file in sorted(path.rglob("*"))
+            if file.is_file() and not file.name.startswith(".")
+        ]
+    else:
+        files = [path]
+    checksums = {}
+    for file in files:
+        name = file.relative_to(path).as_posix() if path.is_dir() else path.name
+        stat = file.stat()
+        status = f"{stat.st_size}-{stat.st_mtime_ns}-{stat.st_ino}"
+        entry = (previous or {}).get(name)
+        if not entry or entry["status"] != status:
+            entry = {"status": status, "sha256": sha256sum(file)}
+        checksums[name] = entry
+    return checksums
+
+
+def _checksum(path: Path, checksums: dict = None) -> str:
+    if checksums is None:
+        checksums = _file_checksums(path)
+    if not path.is_dir():
+        return checksums[path.name]["sha256"]
+    digest = hashlib.sha256()
+    for name, entry in checksums.items():
+        digest.update(f"{name} {entry['sha256']}\n".encode())
+    return digest.hexdigest()
+
+
+def _json_value(value):
+    if isinstance(value, bytes):
+        value = value.decode(errors="replace")
+    if isinstance(value, str):
+        return value[:MAX_STAT_LENGTH]
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+def build_manifest(path: Path, previous: dict = None) -> dict:
+    """
+    Describes a Parquet artifact from its footers alone: schema, row count, size,
+    checksum and per column statistics, without reading any of its data pages.
+    File checksums of a previous manifest are reused for unchanged files.
+    """
+    checksums = _file_checksums(path, (previous or {}).get("checksums"))
+    files = _data_files(path)
+    schema = pq.read_schema(files[0]) if files else None
+    rows = 0
+    columns = {}
+    for file in files:
+        metadata = pq.ParquetFile(file).metadata
+        rows += metadata.num_rows
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            for j in range(row_group.num_columns):
+                chunk = row_group.column(j)
+                stats = columns.setdefault(
+                    chunk.path_in_schema,
+                    {"null_count": 0, "compressed_bytes": 0, "bytes": 0},
+                )
+                stats["compressed_bytes"] += chunk.total_compressed_size
+                stats["bytes"] += chunk.total_uncompressed_size
+                statistics = chunk.statistics
+                if statistics is None:
+                    continue
+                if statistics.has_null_count:
+                    stats["null_count"] += statistics.null_count
+                if statistics.has_min_max:
+                    low = _json_value(statistics.min)
+                    high = _json_value(statistics.max)
+                    if "min" not in stats or low < stats["min"]:
+                        stats["min"] = low
+                    if "max" not in stats or high > stats["max"]:
+                        stats["max"] = high
+
+    return {
+        "name": path.name,
+        "rows": rows,
+        "bytes": sum(file.stat().st_size for file in files),
+        "files": len(files),
+        "sha256": _checksum(path, checksums),
+        "checksums": checksums,
+        "schema": [
+            {"name": field.name, "type": str(field.type)}
+            for field in (schema or [])
+            if not field.name.startswith("__index_level_")
+        ],
+        "columns": columns,
+    }
+
+
+def write_manifest(path: Path) -> dict:
+    target = manifest_path(path)
+    previous = json.loads(target.read_text()) if target.is_file() else None
+    manifest = build_manifest(path, previous)
+    tmp_path = target.with_name(f".{target.name}.tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp_path, target)
+    return manifest
+
+
+def read_manifest(path: Path) -> dict:
+    """
+    Returns the manifest of an artifact, writing it first for artifacts that
+    were cached before manifests existed.
+    """
+    target = manifest_path(path)
+    if target.is_file():
+        return json.loads(target.read_text())
+    return write_manifest(path)
+
+
+def find_artifacts(root: Path) -> List[Path]:
+    """
+    Parquet artifacts under a cache directory. Partitions inside a partitioned
+    artifact are part of it rather than artifacts of their own.
+    """
+    artifacts = []
+    for path in sorted(Path(root).rglob("*.parquet")):
+        relative = path.relative_to(root)
+        if any(part.startswith(".") for part in relative.parts):
+            continue
+        if any(parent.suffix == ".parquet" for parent in relative.parents):
+            continue
+        artifacts.append(path)
+    return artifacts
+
+
+def verify(path: Path) -> List[str]:
+    """
+    Compares an artifact against its manifest and returns the problems found.
+    Every file is read again, stored checksums are not trusted here.
+    """
+    target = manifest_path(path)
+    if not target.is_file():
+        return ["no manifest"]
+    manifest = json.loads(target.read_text())
+    problems = []
+    checksums = _file_checksums(path)
+    if _checksum(path, checksums) != manifest["sha256"]:
+        expected = manifest.get("checksums", {})
+        changed = sorted(
+            name
+            for name in checksums.keys() | expected.keys()
+            if checksums.get(name, {}).get("sha256")
+            != expected.get(name, {}).get("sha256")
+        )
+        problems.append(
+            f"checksum mismatch in {', '.join(changed)}"
+            if expected
+            else "checksum mismatch"
+        )
+    rows = sum(pq.ParquetFile(file).metadata.num_rows for file in _data_files(path))
+    if rows != manifest["rows"]:
+        problems.append(f"expected {manifest['rows']} rows, found {rows}")
+    return problems
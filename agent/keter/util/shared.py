@@ -0,0 +1,48 @@
+from typing import Dict
+from multiprocessing import shared_memory
+import numpy as np
+
+# Segments attached in this process, kept open for as long as the process lives
+_attached = []
+
+
+class SharedArrays:
+    """
+    Publishes NumPy arrays in shared memory, so worker processes can use them
+    without each receiving a pickled copy. Create it in the parent process, hand
+    spec to the workers and open it there with attach().
+    """
+
+    def __init__(self, **arrays: np.ndarray):
+        self._segments = []
+        self.arrays = {}
+        self.spec = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            segment = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            shared = np.ndarray(array.shape, array.dtype, buffer=segment.buf)
+            shared[...] = array
+            self._segments.append(segment)
+            self.arrays[name] = shared
+            self.spec[name] = (segment.name, array.shape, array.dtype.str)
+
+    def __enter__(self) -> "SharedArrays":
+        return self
+
+    def __exit__(self, *kwargs):
+        self.arrays = {}
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments = []
+
+
+def attach(spec: dict, writable: bool = False) -> Dict[str, np.ndarray]:
+    arrays = {}
+    for name, (segment_name, shape, dtype) in spec.items():
+        segment = shared_memory.SharedMemory(name=segment_name)
+        _attached.append(segment)
+        array = np.ndarray(shape, np.dtype(dtype), buffer=segment.buf)
+        array.flags.writeable = writable
+        arrays[name] = array
+    return arrays
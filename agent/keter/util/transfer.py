@@ -0,0 +1,345 @@
+import os
+import time
+import json
+import hashlib
+from uuid import uuid4
+from pathlib import Path
+from typing import Optional
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 16 * 2 ** 20
+
+
+def sha256sum(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fd:
+        for block in iter(lambda: fd.read(CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fetch(url: str, retries: int = 3, backoff: float = 2.0, timeout: float = 60.0):
+    """
+    Downloads a URL into memory, retrying with exponential backoff on network
+    errors and server side failures.
+    """
+    for attempt in range(retries + 1):
+        try:
+            with urlopen(url, timeout=timeout) as response:
+                return response.read()
+        except HTTPError as err:
+            if err.code < 500 or attempt == retries:
+                raise
+        except (URLError, OSError):
+            if attempt == retries:
+                raise
+        time.sleep(backoff ** attempt)
+
+
+def read_mirror_manifest(path: Path) -> dict:
+    """
+    The manifest mirror keeps next to a local copy, empty if there is none.
+    """
+    manifest = path.with_name(path.name + ".json")
+    return json.loads(manifest.read_text()) if manifest.is_file() else {}
+
+
+def _write_manifest(path: Path, manifest: dict):
+    target = path.with_name(path.name + ".json")
+    tmp_path = target.with_name(f".{target.name}.tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp_path, target)
+
+
+def mirror(
+    url: str,
+    path: Path,
+    retries: int = 3,
+    backoff: float = 2.0,
+    timeout: float = 60.0,
+) -> bool:
+    """
+    Keeps a local copy of a URL up to date. A manifest next to the copy records
+    the ETag and Last-Modified validators, size and checksum of the source, so
+    later calls revalidate with a conditional request and only transfer a file
+    that changed. Interrupted transfers resume from the partial file with a
+    ranged request. Returns whether the local copy changed.
+    """
+    path = Path(path)
+    path.parents[0].mkdir(parents=True, exist_ok=True)
+    part_path = path.with_name(path.name + ".part")
+
+    for attempt in range(retries + 1):
+        manifest = read_mirror_manifest(path)
+        if manifest.get("url") != url:
+            manifest = {"url": url}
+        validator = manifest.get("etag") or manifest.get("last_modified")
+
+        headers = {}
+        offset = 0
+        if part_path.exists() and validator:
+            # If-Range makes the server send the whole file if it changed meanwhile
+            offset = part_path.stat().st_size
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+        elif path.exists() and manifest.get("complete"):
+            if manifest.get("etag"):
+                headers["If-None-Match"] = manifest["etag"]
+            if manifest.get("last_modified"):
+                headers["If-Modified-Since"] = manifest["last_modified"]
+
+        try:
+            with urlopen(Request(url, headers=headers), timeout=timeout) as response:
+                if response.status != 206:
+                    offset = 0
+                manifest.update(
+                    etag=response.headers.get("ETag"),
+                    last_modified=response.headers.get("Last-Modified"),
+                    complete=False,
+                )
+                # Validators go to disk first, so an interrupted transfer can resume
+                _write_manifest(path, manifest)
+                with open(part_path, "ab" if offset else "wb") as fd:
+                    for block in iter(lambda: response.read(CHUNK_SIZE), b""):
+                        fd.write(block)
+                length = response.headers.get("Content-Length")
+                if length is not None and part_path.stat().st_size != offset + int(
+                    length
+                ):
+                    raise IOError(f"Connection closed during download of {url}")
+        except HTTPError as err:
+            if err.code == 304:
+                return False
+            elif err.code == 416:
+                # The partial file does not match the source, start over
+                part_path.unlink()
+                continue
+            elif err.code < 500 or attempt == retries:
+                raise
+        except (URLError, OSError):
+            if attempt == retries:
+                raise
+        else:
+            manifest.update(
+                size=part_path.stat().st_size,
+                sha256=sha256sum(part_path),
+                fetched=time.time(),
+                complete=True,
+            )
+            os.replace(part_path, path)
+            _write_manifest(path, manifest)
+            return True
+        time.sleep(backoff ** attempt)
+    raise IOError(f"Could not download {url}")
+
+
+class ChecksumError(IOError):
+    """
+    A transferred artifact does not match its checksum, for example because it
+    was replaced on the remote while it was being read.
+    """
+
+
+def _chunks(size: int, chunk_size: int):
+    for start in range(0, size, chunk_size):
+        yield start, min(chunk_size, size - start)
+
+
+class DirectoryRemote:
+    """
+    A remote that is a plain directory, such as a shared volume or a mounted bucket.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def size(self, name: str) -> Optional[int]:
+        path = self.root / name
+        return path.stat().st_size if path.is_file() else None
+
+    def read_range(self, name: str, start: int, length: int) -> bytes:
+        with open(self.root / name, "rb") as fd:
+            return os.pread(fd.fileno(), length, start)
+
+    def read_text(self, name: str) -> Optional[str]:
+        path = self.root / name
+        return path.read_text() if path.is_file() else None
+
+    def write_text(self, name: str, text: str):
+        path = self.root / name
+        path.parents[0].mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{uuid4().hex}.{path.name}")
+        tmp_path.write_text(text)
+        os.replace(tmp_path, path)
+
+    def put(self, name: str, path: Path, workers: int, chunk_size: int):
+        target = self.root / name
+        target.parents[0].mkdir(parents=True, exist_ok=True)
+        # Concurrent pushers of the same artifact each write their own file
+        tmp_path = target.with_name(f".{uuid4().hex}.{target.name}")
+        size = path.stat().st_size
+        try:
+            with open(path, "rb") as src, open(tmp_path, "wb") as dst:
+                dst.truncate(size)
+
+                def copy_chunk(chunk):
+                    start, length = chunk
+                    data = os.pread(src.fileno(), length, start)
+                    os.pwrite(dst.fileno(), data, start)
+
+                with ThreadPoolExecutor(workers) as executor:
+                    list(executor.map(copy_chunk, _chunks(size, chunk_size)))
+            os.replace(tmp_path, target)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+
+class HttpRemote:
+    """
+    A remote reached over HTTP. The server must support HEAD, ranged GET and PUT,
+    which S3 compatible object stores and simple WebDAV style servers do.
+    """
+
+    def __init__(self, url: str, timeout: float = 60.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, name: str, **kwargs):
+        return urlopen(Request(f"{self.url}/{name}", **kwargs), timeout=self.timeout)
+
+    def size(self, name: str) -> Optional[int]:
+        try:
+            with self._request(name, method="HEAD") as response:
+                return int(response.headers["Content-Length"])
+        except HTTPError as err:
+            if err.code == 404:
+                return None
+            raise
+
+    def read_range(self, name: str, start: int, length: int) -> bytes:
+        headers = {"Range": f"bytes={start}-{start + length - 1}"}
+        with self._request(name, headers=headers) as response:
+            if response.status != 206 and length != self.size(name):
+                raise IOError(f"Remote does not support ranged reads: {self.url}")
+            return response.read()
+
+    def read_text(self, name: str) -> Optional[str]:
+        try:
+            with self._request(name) as response:
+                return response.read().decode()
+        except HTTPError as err:
+            if err.code == 404:
+                return None
+            raise
+
+    def write_text(self, name: str, text: str):
+        self._request(name, data=text.encode(), method="PUT").close()
+
+    def put(self, name: str, path: Path, workers: int, chunk_size: int):
+        # Plain HTTP has no standard multipart upload, so objects go up in one stream
+        with open(path, "rb") as fd:
+            headers = {"Content-Length": str(path.stat().st_size)}
+            self._request(name, data=fd, headers=headers, method="PUT").close()
+
+
+def open_remote(url: str):
+    parsed = urlparse(str(url))
+    if parsed.scheme in ("http", "https"):
+        return HttpRemote(str(url))
+    elif parsed.scheme == "file":
+        return DirectoryRemote(Path(parsed.path))
+    elif not parsed.scheme:
+        return DirectoryRemote(Path(url))
+    else:
+        raise ValueError(f"Unsupported remote: {url}")
+
+
+def download(
+    remote, name: str, path: Path, workers: int = 8, chunk_size: int = CHUNK_SIZE
+) -> bool:
+    """
+    Fetches an artifact from a remote in parallel chunks and verifies its checksum.
+    Returns False if the remote does not have a complete copy of the artifact.
+    """
+    checksum = remote.read_text(name + ".sha256")
+    size = remote.size(name)
+    if checksum is None or size is None:
+        return False
+
+    with open(path, "wb") as fd:
+        fd.truncate(size)
+
+        def fetch_chunk(chunk):
+            start, length = chunk
+            os.pwrite(fd.fileno(), remote.read_range(name, start, length), start)
+
+        with ThreadPoolExecutor(workers) as executor:
+            list(executor.map(fetch_chunk, _chunks(size, chunk_size)))
+
+    if sha256sum(path) != checksum.strip():
+        raise ChecksumError(f"Checksum mismatch for remote artifact: {name}")
+    return True
+
+
+def upload(
+    remote, name: str, path: Path, workers: int = 8, chunk_size: int = CHUNK_SIZE
+):
+    """
+    Sends an artifact to a remote. The checksum is written last, so readers never
+    pick up an artifact whose upload is still in progress.
+    """
+    checksum = sha256sum(path)
+    remote.put(name, path, workers, chunk_size)
+    remote.write_text(name + ".sha256", checksum)
+
+
+def upload_tree(
+    remote, name: str, path: Path, workers: int = 8, chunk_size: int = CHUNK_SIZE
+):
+    """
+    Sends a directory artifact to a remote, one object per file. The listing of
+    its files is written last, so readers never pick up a partial directory.
+    """
+    files = sorted(
+        file.relative_to(path).as_posix()
+        for file in path.rglob("*")
+        if file.is_file()
+        and not any(part.startswith(".") for part in file.relative_to(path).parts)
+    )
+    with ThreadPoolExecutor(workers) as executor:
+        list(
+            executor.map(
+                lambda file: upload(
+                    remote, f"{name}/{file}", path / file, 1, chunk_size
+                ),
+                files,
+            )
+        )
+    remote.write_text(name + ".files", json.dumps(files))
+
+
+def download_tree(
+    remote, name: str, path: Path, workers: int = 8, chunk_size: int = CHUNK_SIZE
+) -> bool:
+    """
+    Fetches a directory artifact uploaded with upload_tree, verifying every file.
+    Returns False if the remote does not have a complete copy of the artifact.
+    """
+    listing = remote.read_text(name + ".files")
+    if listing is None:
+        return False
+    path.mkdir(parents=True, exist_ok=True)
+
+    def fetch_file(file):
+        target = path / file
+        target.parents[0].mkdir(parents=True, exist_ok=True)
+        if not download(remote, f"{name}/{file}", target, 1, chunk_size):
+            raise IOError(f"Remote artifact is missing {file}: {name}")
+
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(fetch_file, json.loads(listing)))
+    return True
@@ -0,0 +1,115 @@
+import re
+import time
+import hashlib
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Serves the files of its server with the parts of HTTP the transfer code uses:
+    ETag and Last-Modified validators, conditional and ranged GET, HEAD and PUT.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def _validators(self, data: bytes):
+        etag = '"%s"' % hashlib.sha256(data).hexdigest()[:16]
+        return etag, formatdate(self.server.modified, usegmt=True)
+
+    def _fail(self) -> bool:
+        # Injected server side failures, counted down per path
+        if self.server.failures.get(self.path, 0) > 0:
+            self.server.failures[self.path] -= 1
+            self.send_error(503)
+            return True
+        return False
+
+    def do_HEAD(self):
+        self.server.requests.append(("HEAD", self.path, dict(self.headers)))
+        if self._fail():
+            return
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        data = self.server.files[self.path]
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path, dict(self.headers)))
+        time.sleep(self.server.delay)
+        if self._fail():
+            return
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        data = self.server.files[self.path]
+        etag, modified = self._validators(data)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start, stop, status = 0, len(data), 200
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range") in (None, etag, modified):
+            start = int(match.group(1))
+            stop = int(match.group(2)) + 1 if match.group(2) else len(data)
+            status = 206
+            if start >= len(data):
+                self.send_error(416)
+                return
+
+        body = data[start:stop]
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", modified)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.server.truncate.pop(self.path, False):
+            # Drop the connection halfway through the body
+            self.wfile.write(body[: len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        self.server.requests.append(("PUT", self.path, dict(self.headers)))
+        length = int(self.headers["Content-Length"])
+        self.server.files[self.path] = self.rfile.read(length)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+@pytest.fixture
+def http_server():
+    """
+    A local HTTP server in a thread. Tests put files in server.files, inject
+    failures with server.failures and server.truncate, slow down GETs with
+    server.delay and inspect server.requests.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.files = {}
+    server.failures = {}
+    server.truncate = {}
+    server.requests = []
+    server.modified = 1600000000
+    server.delay = 0.0
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def cache_root(tmp_path, monkeypatch):
+    monkeypatch.setenv("KETER_CACHE", str(tmp_path / "cache"))
+    return tmp_path / "cache"
@@ -0,0 +1,112 @@
+import pandas as pd
+import keter.datasets.constructed as constructed
+from keter.stage import FileSystemStage
+from keter.datasets.raw import RawData
+from keter.datasets.constructed import CanonicalUnlabeled
+
+
+def _source(path, smiles):
+    pd.DataFrame({"smiles": smiles}).to_csv(path, index=False)
+    return type("Source", (RawData,), {"filename": path.stem, "url": str(path)})()
+
+
+def test_canonical_partitions_follow_source_data(cache_root, tmp_path, monkeypatch):
+    canonicalized = []
+
+    def canonicalize_many(smiles, workers=None):
+        canonicalized.append(list(smiles))
+        return [(s.upper(), s.upper()) for s in smiles]
+
+    monkeypatch.setattr(constructed, "canonicalize_many", canonicalize_many)
+    first = _source(tmp_path / "first.csv", ["c", "cc"])
+    second = _source(tmp_path / "second.csv", ["ccc", "C"])
+    corpus = CanonicalUnlabeled()
+    corpus.dependencies = (first, second)
+
+    with FileSystemStage(content_addressed=True):
+        assert sorted(corpus.to_list()) == ["C", "CC", "CCC"]
+        assert canonicalized == [["c", "cc"], ["ccc", "C"]]
+        key = corpus.key()
+
+        # A new version of one source only canonicalizes that source again
+        _source(tmp_path / "second.csv", ["ccc", "C", "cccc"])
+        assert corpus.key() != key
+        assert sorted(corpus.to_list()) == ["C", "CC", "CCC", "CCCC"]
+        assert canonicalized[2:] == [["ccc", "C", "cccc"]]
+
+
+class _Deaths:
+    """
+    Stands in for CoronaDeathsUSA with two counties and the given report dates.
+    """
+
+    url = "deaths.csv"
+    dates = ["3/1/20", "3/2/20", "3/3/20"]
+
+    def download(self):
+        deaths = pd.DataFrame(
+            {"UID": [1, 2], "Lat": [40.0, 30.0], "Long_": [-75.0, -90.0]}
+        )
+        for i, date in enumerate(self.dates):
+            deaths[date] = [i, 2 * i]
+        return deaths
+
+    to_df = refresh = download
+
+
+def _infection_net(monkeypatch, dates):
+    monkeypatch.setattr(constructed, "CoronaDeathsUSA", _Deaths)
+    monkeypatch.setattr(_Deaths, "dates", dates)
+    net = constructed.InfectionNet()
+    net.workers = 1
+    return net
+
+
+def test_infection_net_query(cache_root, monkeypatch):
+    net = _infection_net(monkeypatch, _Deaths.dates)
+    with FileSystemStage():
+        records = net.to_df()
+        march_2 = 1583107200
+        window = net.query(time=(march_2 - 1296000, march_2), lat=(39, 41))
+        expected = records[
+            records["timestamp"].between(march_2 - 1296000, march_2)
+            & records["lat"].between(39, 41)
+        ]
+        assert len(window) == len(expected) > 0
+
+        # Nothing in range still gives the columns and types of the records
+        empty = net.query(lat=(0, 1), columns=["uid", "lat"])
+        assert list(empty.columns) == ["uid", "lat"] and len(empty) == 0
+        assert list(net.query(lat=(0, 1)).dtypes) == list(records.dtypes)
+
+
+def test_infection_net_query_without_partitions(cache_root, monkeypatch):
+    # A single report date has no new deaths to generate records from
+    net = _infection_net(monkeypatch, ["3/1/20"])
+    with FileSystemStage():
+        net.update(refresh=False)
+        empty = net.query(time=(0, 2 ** 40))
+    assert list(empty.columns) == ["timestamp", "lat", "long", "uid"]
+    assert len(empty) == 0
+
+
+def test_infection_net_concurrent_updates(cache_root, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from keter.util.manifest import read_manifest
+
+    net = _infection_net(monkeypatch, _Deaths.dates[:2])
+    with FileSystemStage():
+        net.to_df()
+        monkeypatch.setattr(_Deaths, "dates", _Deaths.dates + ["3/4/20", "3/5/20"])
+        with ThreadPoolExecutor(4) as executor:
+            added = list(executor.map(lambda _: net.update(), range(4)))
+        records = net.to_df()
+
+        # One update appends the new dates, the others find nothing left to do
+        assert sorted(map(len, added)) == [0, 0, 0, 2]
+        path = cache_root / "data" / "constructed" / "infectionnet.parquet"
+        index = pd.read_parquet(path / "_index.parquet")
+        assert not index.duplicated(["file", "row_group"]).any()
+        assert index["file"].nunique() == 3
+        assert index["rows"].sum() == len(records)
+        assert read_manifest(path)["rows"] == len(records)
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+import pytest
+import keter.datasets.constructed as constructed
+import keter.systems.forecasting as forecasting
+from keter.stage import FileSystemStage
+from keter.systems.forecasting import RollupCube, DAY
+
+
+def _deaths(days):
+    deaths = pd.DataFrame(
+        {
+            "UID": [1, 2, 3],
+            "Province_State": ["Ohio", "Ohio", "Utah"],
+            "Population": [1000.0, 2000.0, 500.0],
+            "Lat": [40.0, 41.0, 39.0],
+            "Long_": [-83.0, -82.0, -111.0],
+        }
+    )
+    for day in range(days):
+        deaths[f"3/{day + 1}/20"] = [day, 2 * day, day // 2]
+    return deaths
+
+
+class _Deaths:
+    url = "deaths.csv"
+    days = 4
+
+    def download(self):
+        return _deaths(self.days)
+
+    to_df = refresh = download
+
+
+@pytest.fixture(autouse=True)
+def deaths(monkeypatch):
+    monkeypatch.setattr(constructed, "CoronaDeathsUSA", _Deaths)
+    monkeypatch.setattr(forecasting, "CoronaDeathsUSA", _Deaths)
+    return _Deaths
+
+
+def _arrays(cube):
+    return {
+        (measure, level): np.array(cube.series(measure, level))
+        for measure in cube.measures
+        for level in cube.levels
+    }
+
+
+def _rebuilt(tmp_path, monkeypatch, days):
+    monkeypatch.setenv("KETER_CACHE", str(tmp_path / f"rebuilt-{days}"))
+    monkeypatch.setattr(_Deaths, "days", days)
+    with FileSystemStage():
+        return _arrays(RollupCube())
+
+
+def _assert_same(arrays, expected):
+    assert arrays.keys() == expected.keys()
+    for key in expected:
+        np.testing.assert_array_equal(arrays[key], expected[key], err_msg=str(key))
+
+
+def test_update_matches_rebuild(cache_root, tmp_path, monkeypatch):
+    with FileSystemStage():
+        cube = RollupCube()
+        assert cube.update() == []
+        added = cube.update(_deaths(7))
+        assert len(added) == 3 and cube.days == RollupCube().days
+        arrays = _arrays(cube)
+
+    _assert_same(arrays, _rebuilt(tmp_path, monkeypatch, 7))
+    assert arrays["deaths", "nation"].sum() == _deaths(7).iloc[:, -1].sum()
+
+
+def test_interrupted_update_is_rolled_back(cache_root, tmp_path, monkeypatch):
+    add = RollupCube._add
+
+    def crash_on_infections(self, measure, first_day, block):
+        if measure == "infections":
+            raise KeyboardInterrupt
+        add(self, measure, first_day, block)
+
+    with FileSystemStage():
+        RollupCube()
+        with monkeypatch.context() as patch:
+            patch.setattr(RollupCube, "_add", crash_on_infections)
+            with pytest.raises(KeyboardInterrupt):
+                RollupCube().update(_deaths(7))
+
+        # The rerun rolls back the deaths added before the crash
+        assert len(RollupCube().update(_deaths(7))) == 3
+        arrays = _arrays(RollupCube())
+    _assert_same(arrays, _rebuilt(tmp_path, monkeypatch, 7))
+
+
+def test_update_interrupted_after_saving_is_kept(cache_root, tmp_path, monkeypatch):
+    with FileSystemStage():
+        RollupCube()
+        with monkeypatch.context() as patch:
+            unlink = forecasting.Path.unlink
+
+            def crash_on_cleanup(path, *args):
+                if path.name == "undo.npz":
+                    raise KeyboardInterrupt
+                unlink(path, *args)
+
+            patch.setattr(forecasting.Path, "unlink", crash_on_cleanup)
+            with pytest.raises(KeyboardInterrupt):
+                RollupCube().update(_deaths(7))
+
+        assert RollupCube().update(_deaths(7)) == []
+        arrays = _arrays(RollupCube())
+        assert not (RollupCube().path / "undo.npz").exists()
+    _assert_same(arrays, _rebuilt(tmp_path, monkeypatch, 7))
+
+
+def test_features(cache_root):
+    with FileSystemStage():
+        cube = RollupCube()
+        end = int(cube.dates[-1])
+        features = cube.features("deaths", end, 3, level="state")
+        assert features.shape == (2, 3)
+        np.testing.assert_array_equal(
+            features, np.asarray(cube.series("deaths", "state")[-3:]).T
+        )
+        weekly = cube.features("infections", end, 2, window=7)
+        assert weekly.shape == (3, 2)
+
+        with pytest.raises(ValueError):
+            cube.features("deaths", int(cube.dates[2]), 5)
+        with pytest.raises(ValueError):
+            cube.features("deaths", end + DAY, 1)
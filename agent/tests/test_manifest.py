@@ -0,0 +1,56 @@
+import pandas as pd
+import keter.util.manifest as manifest
+from keter.util.manifest import read_manifest, write_manifest, verify
+
+
+def _partition(path, day):
+    pd.DataFrame({"day": [day] * 3, "cases": [1, 2, 3]}).to_parquet(
+        path / f"{day}.parquet"
+    )
+
+
+def test_manifest_only_hashes_new_files(tmp_path, monkeypatch):
+    path = tmp_path / "cases.parquet"
+    path.mkdir()
+    for day in range(3):
+        _partition(path, day)
+    write_manifest(path)
+
+    hashed = []
+    sha256sum = manifest.sha256sum
+    monkeypatch.setattr(
+        manifest, "sha256sum", lambda file: hashed.append(file.name) or sha256sum(file)
+    )
+    _partition(path, 3)
+    described = write_manifest(path)
+    assert hashed == ["3.parquet"]
+    assert described["rows"] == 12 and described["files"] == 4
+
+    # The reused checksums add up to the same digest as hashing everything
+    hashed.clear()
+    assert verify(path) == []
+    assert sorted(hashed) == ["0.parquet", "1.parquet", "2.parquet", "3.parquet"]
+
+
+def test_manifest_rehashes_changed_files(tmp_path):
+    path = tmp_path / "cases.parquet"
+    path.mkdir()
+    for day in range(2):
+        _partition(path, day)
+    write_manifest(path)
+
+    pd.DataFrame({"day": [1], "cases": [9]}).to_parquet(path / "1.parquet")
+    assert verify(path) == [
+        "checksum mismatch in 1.parquet",
+        "expected 6 rows, found 4",
+    ]
+    write_manifest(path)
+    assert verify(path) == []
+
+
+def test_single_file_manifest(tmp_path):
+    path = tmp_path / "table.parquet"
+    pd.DataFrame({"a": [1, 2]}).to_parquet(path)
+    first = read_manifest(path)
+    assert write_manifest(path)["sha256"] == first["sha256"] == manifest.sha256sum(path)
+    assert verify(path) == []
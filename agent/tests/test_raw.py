@@ -0,0 +1,72 @@
+import pandas as pd
+import pytest
+from keter.stage import FileSystemStage
+from keter.datasets.raw import RawData
+
+
+def _source(path, text, chunksize=3):
+    path.write_text(text)
+    return type(
+        "Source",
+        (RawData,),
+        {"filename": path.stem, "url": str(path), "chunksize": chunksize},
+    )()
+
+
+def test_ingest_promotes_types_across_chunks(cache_root, tmp_path):
+    rows = [
+        # label is empty in the whole first chunk and text later on, count gets
+        # a missing value in the second chunk and id never does
+        (1, "", 4, "C"),
+        (2, "", 5, "CC"),
+        (3, "", 6, "CCC"),
+        (4, "active", "", "CCCC"),
+        (5, "", 8, "CCCCC"),
+        (6, "inactive", 9, "CCCCCC"),
+        (7, "", 10, "CCCCCCC"),
+    ]
+    text = "id,label,count,smiles\n" + "".join(
+        ",".join(map(str, row)) + "\n" for row in rows
+    )
+    source = _source(tmp_path / "mixed.csv", text)
+
+    with FileSystemStage():
+        streamed = source.to_df()
+    expected = pd.read_csv(source.url)
+
+    assert list(streamed.dtypes.astype(str)) == list(expected.dtypes.astype(str))
+    assert streamed["id"].dtype == "int64"
+    assert streamed["count"].dtype == "float64"
+    pd.testing.assert_frame_equal(streamed, expected)
+
+
+def test_ingest_keeps_numbers_and_text_as_text(cache_root, tmp_path):
+    text = "code,value\n" + "1,1\n2,2\n3,3\n" + "A4,4\nB5,5\n"
+    source = _source(tmp_path / "codes.csv", text)
+
+    with FileSystemStage():
+        streamed = source.to_df()
+    assert streamed["code"].tolist() == ["1", "2", "3", "A4", "B5"]
+    assert streamed["value"].tolist() == [1, 2, 3, 4, 5]
+
+
+def test_ingest_column_empty_in_every_chunk(cache_root, tmp_path):
+    text = "smiles,note\n" + "C,\n" * 7
+    source = _source(tmp_path / "empty_column.csv", text)
+
+    with FileSystemStage():
+        streamed = source.to_df()
+    assert streamed["note"].dtype == "float64"
+    assert streamed["note"].isna().all()
+
+
+@pytest.mark.parametrize("text", ["smiles,label\n", ""])
+def test_ingest_empty_source(cache_root, tmp_path, text):
+    source = _source(tmp_path / "empty.csv", text)
+
+    with FileSystemStage():
+        streamed = source.to_df()
+        assert len(streamed) == 0
+        assert list(streamed.columns) == (["smiles", "label"] if text else [])
+        # The artifact exists, later reads come from the cache
+        assert len(source.scan(["smiles"] if text else None).to_df()) == 0
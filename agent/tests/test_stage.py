@@ -0,0 +1,124 @@
+import logging
+import sys
+import types
+import warnings
+import pandas as pd
+import pytest
+from keter.stage import (
+    FileSystemStage,
+    MemoryStage,
+    RemoteStage,
+    cache,
+    fingerprint,
+    get_path,
+)
+from keter.util.transfer import DirectoryRemote
+
+
+def _write_partitions(path):
+    path.mkdir()
+    for day in range(3):
+        pd.DataFrame({"day": [day] * 4, "cases": range(4)}).to_parquet(
+            path / f"{day}.parquet"
+        )
+    pd.DataFrame({"day": range(3)}).to_parquet(path / "_index.parquet")
+
+
+def test_remote_stage_round_trips_directory_artifacts(
+    tmp_path, cache_root, monkeypatch
+):
+    remote = tmp_path / "remote"
+
+    def unreachable():
+        raise AssertionError("pulled artifacts are not rebuilt")
+
+    with RemoteStage(str(remote)):
+        cache("constructed", "cases.parquet", unreachable, writer=_write_partitions)
+        cache("model", "weights.pkz", lambda: {"weights": [1, 2, 3]})
+    assert (remote / "data" / "constructed" / "cases.parquet.files").is_file()
+    assert (remote / "data" / "constructed" / "cases.parquet.json").is_file()
+
+    # A second machine with an empty cache pulls instead of building
+    monkeypatch.setenv("KETER_CACHE", str(tmp_path / "other"))
+    with RemoteStage(str(remote)):
+        assert cache("model", "weights.pkz", unreachable) == {"weights": [1, 2, 3]}
+        df = cache("constructed", "cases.parquet", unreachable)
+        path = get_path("constructed") / "cases.parquet"
+
+    assert sorted(df["day"]) == sorted([0, 1, 2] * 4)
+    assert sorted(p.name for p in path.iterdir()) == [
+        "0.parquet",
+        "1.parquet",
+        "2.parquet",
+        "_index.parquet",
+    ]
+    assert (path.parent / "cases.parquet.json").read_text() == (
+        cache_root / "data" / "constructed" / "cases.parquet.json"
+    ).read_text()
+
+
+def test_remote_stage_builds_missing_artifacts(tmp_path, cache_root):
+    with RemoteStage(str(tmp_path / "remote"), push=False):
+        assert cache("model", "weights.pkz", lambda: [1]) == [1]
+    assert not (tmp_path / "remote").exists()
+
+
+def test_fingerprint_functions_without_source(monkeypatch):
+    # Builtins and functions defined in python -c have no module file to read
+    scratch = types.ModuleType("scratch")
+    exec("double = lambda x: 2 * x", scratch.__dict__)
+    monkeypatch.setitem(sys.modules, "scratch", scratch)
+
+    assert fingerprint(len) == fingerprint(len)
+    assert fingerprint(len) != fingerprint(sum)
+    assert fingerprint(scratch.double) == fingerprint(scratch.double)
+
+
+class _ReplacedRemote(DirectoryRemote):
+    """
+    Directory remote whose artifacts are replaced while the first reads of them
+    are in progress, as by a concurrent push.
+    """
+
+    def __init__(self, root, replaced_reads):
+        super().__init__(root)
+        self.replaced_reads = replaced_reads
+
+    def read_range(self, name, start, length):
+        if name.endswith(".pkz") and self.replaced_reads:
+            self.replaced_reads -= 1
+            return bytes(length)
+        return super().read_range(name, start, length)
+
+
+@pytest.mark.parametrize("replaced_reads, builds", [(1, 0), (2, 1)])
+def test_remote_stage_pulls_again_after_checksum_mismatch(
+    tmp_path, cache_root, monkeypatch, replaced_reads, builds
+):
+    remote = tmp_path / "remote"
+    with RemoteStage(str(remote)):
+        cache("model", "weights.pkz", lambda: {"weights": [1, 2, 3]})
+
+    built = []
+
+    def build():
+        built.append(True)
+        return {"weights": [1, 2, 3]}
+
+    monkeypatch.setenv("KETER_CACHE", str(tmp_path / "other"))
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        stage = RemoteStage(str(remote), push=False)
+        with stage:
+            stage.remote = _ReplacedRemote(remote, replaced_reads)
+            assert cache("model", "weights.pkz", build) == {"weights": [1, 2, 3]}
+    assert len(built) == builds
+    assert len(caught) == builds
+
+
+def test_memory_stage_logs_stats_on_exit(cache_root, caplog):
+    caplog.set_level(logging.INFO, logger="keter.stage")
+    with MemoryStage(FileSystemStage()):
+        for _ in range(3):
+            cache("constructed", "frame.parquet", lambda: pd.DataFrame({"a": [1]}))
+    assert "Memory stage: 2 hits, 1 misses, 1 entries" in caplog.text
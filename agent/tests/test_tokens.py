@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from keter.models.tokens import TokenIndex, map_chunks
+
+
+class _Items:
+    """
+    A sequence that records which slices were taken from it.
+    """
+
+    def __init__(self, size):
+        self.items = list(range(size))
+        self.sliced = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        self.sliced.append(index.start)
+        return self.items[index]
+
+
+class _CountingExecutor(ThreadPoolExecutor):
+    submitted = 0
+
+    def submit(self, func, *args):
+        self.submitted += 1
+        return super().submit(func, *args)
+
+
+def test_map_chunks_in_order_with_a_bounded_window():
+    items = _Items(1000)
+    with _CountingExecutor(2) as executor:
+        results = map_chunks(sum, items, 2, chunk_size=10, executor=executor)
+        first = next(results)
+        # Two chunks per worker are cut and submitted before the first result
+        assert first == sum(range(10))
+        assert executor.submitted == len(items.sliced) == 4
+        rest = list(results)
+        assert [first] + rest == [sum(range(i, i + 10)) for i in range(0, 1000, 10)]
+        assert executor.submitted == 100
+        # A caller's executor is reused, not shut down
+        assert (
+            list(map_chunks(len, items, 2, chunk_size=10, executor=executor))
+            == [10] * 100
+        )
+
+
+def test_map_chunks_runs_in_process():
+    assert list(map_chunks(sum, list(range(25)), 4, chunk_size=10)) == [45, 145, 110]
+    assert list(map_chunks(sum, list(range(5)), 4, chunk_size=10)) == [10]
+    assert list(map_chunks(sum, [], 4, chunk_size=10)) == []
+
+
+def test_map_chunks_worker_processes():
+    chunks = list(map_chunks(sum, list(range(100)), 2, chunk_size=10))
+    assert chunks == [sum(range(i, i + 10)) for i in range(0, 100, 10)]
+
+
+def test_encode_with_shared_executor():
+    index = TokenIndex(["C", "C C", "O", "c1", "N"], max_ngram=2, chunk_size=7)
+    smiles = ["CCO", "c1ccccc1", "CN", "CCCCO", "OCC"] * 20
+    features, indptr = index.encode(smiles, workers=1)
+    with ThreadPoolExecutor(2) as executor:
+        shared = index.encode(smiles, 2, executor)
+        bows = index.bow(smiles, 2, executor)
+    np.testing.assert_array_equal(shared[0], features)
+    np.testing.assert_array_equal(shared[1], indptr)
+    assert bows.shape == (len(smiles), len(index))
+    assert bows.sum() == len(features)
@@ -0,0 +1,97 @@
+import time
+from io import BytesIO
+from zipfile import ZipFile
+import pandas as pd
+import pytest
+import keter.util.transfer
+from keter.stage import FileSystemStage
+from keter.util.transfer import fetch
+from keter.datasets.constructed_safety import Tox21Full
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(keter.util.transfer.time, "sleep", lambda seconds: None)
+
+
+def test_fetch_retries_server_errors(http_server):
+    http_server.files["/data"] = b"payload"
+    http_server.failures["/data"] = 2
+    assert fetch(http_server.url + "/data", retries=3) == b"payload"
+    assert [path for _, path, _ in http_server.requests] == ["/data"] * 3
+
+
+def test_fetch_gives_up(http_server):
+    http_server.files["/data"] = b"payload"
+    http_server.failures["/data"] = 5
+    with pytest.raises(keter.util.transfer.HTTPError):
+        fetch(http_server.url + "/data", retries=2)
+    assert len(http_server.requests) == 3
+
+
+def test_fetch_does_not_retry_client_errors(http_server):
+    with pytest.raises(keter.util.transfer.HTTPError):
+        fetch(http_server.url + "/missing", retries=3)
+    assert len(http_server.requests) == 1
+
+
+def _assay_zip(assay: str, rows: int) -> bytes:
+    table = pd.DataFrame(
+        {"SAMPLE_ID": [f"{assay}-{i}" for i in range(rows)], "ACTIVITY": range(rows)}
+    )
+    buffer = BytesIO()
+    with ZipFile(buffer, "w") as zip_fd:
+        zip_fd.writestr(f"{assay}.txt", "unrelated")
+        zip_fd.writestr(
+            f"{assay}.aggregrated.txt", table.to_csv(sep="\t", index=False)
+        )
+    return buffer.getvalue()
+
+
+def _tox21(http_server, assays):
+    tox21 = Tox21Full()
+    tox21.assay_url = http_server.url + "/assays/{assay}.zip"
+    tox21.tox21_assays = assays
+    tox21.workers = len(assays)
+    for i, assay in enumerate(assays):
+        http_server.files[f"/assays/{assay}.zip"] = _assay_zip(assay, i + 1)
+    return tox21
+
+
+def test_assays_fetched_in_parallel_and_in_order(cache_root, http_server):
+    assays = [f"tox21-assay{i}-p1" for i in range(4)]
+    tox21 = _tox21(http_server, assays)
+    http_server.delay = 0.5
+
+    start = time.perf_counter()
+    with FileSystemStage():
+        results = list(tox21.to_dfs())
+    # Serially this takes at least four delays
+    assert time.perf_counter() - start < 1.5
+
+    assert [assay for assay, _ in results] == assays
+    for i, (assay, df) in enumerate(results):
+        assert df["SAMPLE_ID"].tolist() == [f"{assay}-{j}" for j in range(i + 1)]
+
+
+def test_assay_fetch_retries_and_caches(cache_root, http_server):
+    assays = ["tox21-flaky-p1", "tox21-steady-p1"]
+    tox21 = _tox21(http_server, assays)
+    http_server.failures["/assays/tox21-flaky-p1.zip"] = 2
+
+    with FileSystemStage():
+        first = dict(tox21.to_dfs())
+        requests = len(http_server.requests)
+        second = dict(tox21.to_dfs())
+
+    assert requests == 4
+    # The second pass reads the cached archives without touching the server
+    assert len(http_server.requests) == requests
+    for assay in assays:
+        pd.testing.assert_frame_equal(first[assay], second[assay])
+
+
+def test_unknown_assay(http_server):
+    tox21 = _tox21(http_server, ["tox21-assay0-p1"])
+    with pytest.raises(ValueError):
+        tox21.download("tox21-other-p1")
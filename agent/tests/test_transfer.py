@@ -0,0 +1,228 @@
+import os
+import pytest
+from keter.util.transfer import (
+    DirectoryRemote,
+    HttpRemote,
+    open_remote,
+    download,
+    upload,
+    mirror,
+    read_mirror_manifest,
+    sha256sum,
+)
+
+
+@pytest.fixture
+def artifact(tmp_path):
+    path = tmp_path / "artifact.bin"
+    path.write_bytes(os.urandom(100000))
+    return path
+
+
+def test_directory_remote_round_trip(tmp_path, artifact):
+    remote = open_remote(str(tmp_path / "remote"))
+    assert isinstance(remote, DirectoryRemote)
+    upload(remote, "models/artifact.bin", artifact, workers=4, chunk_size=4096)
+
+    assert (tmp_path / "remote" / "models" / "artifact.bin.sha256").read_text() == (
+        sha256sum(artifact)
+    )
+    # No temporary files are left behind
+    assert sorted(p.name for p in (tmp_path / "remote" / "models").iterdir()) == [
+        "artifact.bin",
+        "artifact.bin.sha256",
+    ]
+
+    target = tmp_path / "pulled.bin"
+    assert download(remote, "models/artifact.bin", target, workers=4, chunk_size=4096)
+    assert target.read_bytes() == artifact.read_bytes()
+
+
+def test_directory_remote_missing(tmp_path):
+    remote = DirectoryRemote(tmp_path / "remote")
+    assert not download(remote, "missing.bin", tmp_path / "missing.bin")
+
+
+def test_directory_remote_checksum_mismatch(tmp_path, artifact):
+    remote = DirectoryRemote(tmp_path / "remote")
+    upload(remote, "artifact.bin", artifact, chunk_size=4096)
+    remote.write_text("artifact.bin.sha256", "0" * 64)
+    with pytest.raises(IOError):
+        download(remote, "artifact.bin", tmp_path / "pulled.bin", chunk_size=4096)
+
+
+def test_directory_remote_concurrent_puts(tmp_path, artifact):
+    from concurrent.futures import ThreadPoolExecutor
+
+    remote = DirectoryRemote(tmp_path / "remote")
+    with ThreadPoolExecutor(4) as executor:
+        list(
+            executor.map(
+                lambda _: remote.put("artifact.bin", artifact, 2, 4096), range(8)
+            )
+        )
+    assert (tmp_path / "remote" / "artifact.bin").read_bytes() == artifact.read_bytes()
+    assert [p.name for p in (tmp_path / "remote").iterdir()] == ["artifact.bin"]
+
+
+def test_http_remote_round_trip(http_server, tmp_path, artifact):
+    remote = open_remote(http_server.url + "/store")
+    assert isinstance(remote, HttpRemote)
+    upload(remote, "artifact.bin", artifact)
+    assert http_server.files["/store/artifact.bin"] == artifact.read_bytes()
+
+    target = tmp_path / "pulled.bin"
+    assert download(remote, "artifact.bin", target, workers=4, chunk_size=4096)
+    assert target.read_bytes() == artifact.read_bytes()
+    ranged = [
+        headers["Range"]
+        for method, path, headers in http_server.requests
+        if method == "GET" and path == "/store/artifact.bin"
+    ]
+    assert len(ranged) == 25
+
+
+def test_http_remote_checksum_mismatch(http_server, tmp_path, artifact):
+    remote = HttpRemote(http_server.url)
+    upload(remote, "artifact.bin", artifact)
+    http_server.files["/artifact.bin"] = b"corrupted" + artifact.read_bytes()[9:]
+    with pytest.raises(IOError):
+        download(remote, "artifact.bin", tmp_path / "pulled.bin", chunk_size=4096)
+
+
+def test_http_remote_missing(http_server, tmp_path):
+    assert not download(HttpRemote(http_server.url), "missing", tmp_path / "missing")
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    import keter.util.transfer
+
+    monkeypatch.setattr(keter.util.transfer.time, "sleep", lambda seconds: None)
+
+
+def _gets(http_server, path):
+    return [
+        headers for method, p, headers in http_server.requests if (method, p) == path
+    ]
+
+
+def test_mirror_revalidates_with_etag(http_server, tmp_path):
+    http_server.files["/data.csv"] = b"smiles\nC\n"
+    target = tmp_path / "data.csv"
+
+    assert mirror(http_server.url + "/data.csv", target)
+    assert target.read_bytes() == b"smiles\nC\n"
+    manifest = read_mirror_manifest(target)
+    assert manifest["complete"] and manifest["sha256"] == sha256sum(target)
+
+    # Unchanged upstream: a 304 and the copy is left alone
+    assert not mirror(http_server.url + "/data.csv", target)
+    headers = _gets(http_server, ("GET", "/data.csv"))[-1]
+    assert headers["If-None-Match"] == manifest["etag"]
+    assert headers["If-Modified-Since"] == manifest["last_modified"]
+
+    http_server.files["/data.csv"] = b"smiles\nCC\n"
+    assert mirror(http_server.url + "/data.csv", target)
+    assert target.read_bytes() == b"smiles\nCC\n"
+    assert read_mirror_manifest(target)["sha256"] != manifest["sha256"]
+
+
+def test_mirror_resumes_interrupted_transfer(http_server, tmp_path, no_backoff):
+    data = os.urandom(200000)
+    http_server.files["/big.bin"] = data
+    http_server.truncate["/big.bin"] = True
+    target = tmp_path / "big.bin"
+
+    assert mirror(http_server.url + "/big.bin", target)
+    assert target.read_bytes() == data
+    assert not target.with_name("big.bin.part").exists()
+
+    first, second = _gets(http_server, ("GET", "/big.bin"))
+    assert "Range" not in first
+    assert second["Range"] == f"bytes={len(data) // 2}-"
+    assert second["If-Range"] == read_mirror_manifest(target)["etag"]
+
+
+def test_mirror_restarts_when_source_changed_mid_transfer(
+    http_server, tmp_path, no_backoff
+):
+    http_server.files["/big.bin"] = os.urandom(100000)
+    http_server.truncate["/big.bin"] = True
+    target = tmp_path / "big.bin"
+    # The first attempt is cut off and leaves a partial file behind
+    with pytest.raises(IOError):
+        mirror(http_server.url + "/big.bin", target, retries=0)
+    assert target.with_name("big.bin.part").exists()
+
+    # If-Range no longer matches, so the whole new file comes back
+    http_server.files["/big.bin"] = data = os.urandom(150000)
+    assert mirror(http_server.url + "/big.bin", target)
+    assert target.read_bytes() == data
+
+
+def test_mirror_restarts_on_unsatisfiable_range(http_server, tmp_path, no_backoff):
+    http_server.files["/data.bin"] = data = os.urandom(1000)
+    http_server.truncate["/data.bin"] = True
+    target = tmp_path / "data.bin"
+    with pytest.raises(IOError):
+        mirror(http_server.url + "/data.bin", target, retries=0)
+
+    # A partial file at least as long as the source cannot be resumed
+    target.with_name("data.bin.part").write_bytes(os.urandom(2000))
+    assert mirror(http_server.url + "/data.bin", target)
+    assert target.read_bytes() == data
+    resumed, restarted = _gets(http_server, ("GET", "/data.bin"))[1:]
+    assert resumed["Range"] == "bytes=2000-"
+    assert "Range" not in restarted
+
+
+def test_raw_data_refresh_changes_key(http_server, cache_root):
+    from keter.stage import FileSystemStage
+    from keter.datasets.raw import RawData
+
+    http_server.files["/source.csv"] = b"smiles\nC\n"
+    source = type(
+        "Source",
+        (RawData,),
+        {"filename": "source", "url": http_server.url + "/source.csv"},
+    )()
+
+    with FileSystemStage(content_addressed=True):
+        assert source.to_df()["smiles"].tolist() == ["C"]
+        key = source.key()
+        assert key != RawData.key(type("Unfetched", (RawData,), {"url": "x.csv"})())
+
+        # Unchanged upstream keeps the key and the cached data
+        assert source.refresh()["smiles"].tolist() == ["C"]
+        assert source.key() == key
+
+        http_server.files["/source.csv"] = b"smiles\nCC\n"
+        assert source.refresh()["smiles"].tolist() == ["CC"]
+        assert source.key() != key
+        assert source.to_df()["smiles"].tolist() == ["CC"]
+
+
+def test_raw_data_cold_cache_builds_once(http_server, cache_root):
+    from keter.stage import FileSystemStage, get_path
+    from keter.datasets.raw import RawData
+
+    builds = []
+
+    class Source(RawData):
+        filename = "source"
+        url = http_server.url + "/source.csv"
+
+        def download(self):
+            builds.append(self.version())
+            return super().download()
+
+    http_server.files["/source.csv"] = b"smiles\nC\n"
+    source = Source()
+    with FileSystemStage(content_addressed=True):
+        # The first key fetches the source, so the second call finds the artifact
+        assert source.to_df()["smiles"].tolist() == ["C"]
+        assert source.to_df()["smiles"].tolist() == ["C"]
+    assert len(builds) == 1
+    assert len(list(get_path("raw").glob("source*.parquet"))) == 1
+    assert len(_gets(http_server, ("GET", "/source.csv"))) == 1
@@ -0,0 +1,33 @@
+from keter.models.tokens import TokenIndex
+from keter.models.vectors import (
+    ChemicalLanguageModule,
+    ChemicalLanguageHyperparameters,
+)
+
+
+def test_write_corpus_in_chunks(tmp_path, monkeypatch):
+    module = ChemicalLanguageModule(
+        ChemicalLanguageHyperparameters.from_dict({"token_ids": True})
+    )
+    module.tokens = TokenIndex(["C", "C C", "O", "c1", "N"], max_ngram=2)
+    module.workers = 1
+    module.corpus_chunk_size = 7
+    smiles = ["CCO", "c1ccccc1", "CN", "CCCCO", "OCC", "[Na+]"] * 5
+
+    encoded = []
+    encode = TokenIndex.encode
+    monkeypatch.setattr(
+        TokenIndex,
+        "encode",
+        lambda self, X, *args: encoded.append(len(X)) or encode(self, X, *args),
+    )
+    corpus = tmp_path / "corpus.txt"
+    # c1ccccc1 and [Na+] have no tokens in the vocabulary and are left out
+    assert module._write_corpus(smiles, corpus) == 4 * 5
+
+    # The whole corpus is never encoded at once
+    assert encoded == [7, 7, 7, 7, 2]
+    expected = [
+        " ".join(words) for words in module.tokens.documents(smiles, 1) if words
+    ]
+    assert corpus.read_text().splitlines() == expected
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import csr_matrix
+from sklearn.feature_selection import mutual_info_classif
+from keter.models.vocabulary import mutual_information
+
+
+def _counts(rng, documents, features):
+    return csr_matrix(rng.poisson(0.3, (documents, features)))
+
+
+def test_mutual_information_matches_sklearn_across_chunks():
+    rng = np.random.default_rng(22)
+    X = _counts(rng, 100, 2500)
+    Y = pd.DataFrame({f"label_{i}": rng.choice([0, 1, -1], 100) for i in range(2)})
+
+    expected = np.stack(
+        [mutual_info_classif(X, Y[i], discrete_features=True) for i in Y], axis=1
+    )
+    assert np.allclose(mutual_information(X, Y), expected, rtol=0, atol=1e-12)
+    assert np.array_equal(mutual_information(X, Y, workers=2), mutual_information(X, Y))
+
+
+def test_mutual_information_rejects_missing_labels():
+    rng = np.random.default_rng(22)
+    Y = pd.DataFrame({"a": [0, 1, 0, 1], "b": [1.0, np.nan, 0.0, 1.0]})
+    with pytest.raises(ValueError):
+        mutual_information(_counts(rng, 4, 3), Y)